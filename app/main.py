@@ -1,19 +1,70 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import email.utils
+import fcntl
+import functools
+import gzip
+import hashlib
+import hmac
+import html
+import jinja2
 import json
-import requests
-import smtplib
+import logging
+import mimetypes
+import os
+import random
+import re
+import signal
+import sqlite3
 import ssl
+import threading
+import time
+import urllib.parse
 import uuid
 import yaml
-from fastapi import FastAPI, Request, status
+from fastapi import FastAPI, Query, Request, Response, status
 from fastapi.openapi.docs import (
     get_redoc_html,
     get_swagger_ui_html,
     get_swagger_ui_oauth2_redirect_html,
 )
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    JSONResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
+from starlette.routing import Match
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# orjson parses and encodes several times faster than the standard library, and is
+# used whenever it's installed. Either way, encoding gives bytes.
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+    json_loads = json.loads
+
+    def json_dumps(value):
+        return json.dumps(value).encode()
+
 
 all_outputs = (
     "discord",
@@ -27,50 +78,146 @@ all_outputs = (
     "webhook",
 )
 
-with open("/code/app/config.yaml", mode="rt", encoding="utf-8") as file:
-    configuration = yaml.safe_load(file)
+circuit_error_rate = 0.5
+circuit_failures = 5
+circuit_open_time = 60
+circuit_window = 20
+custom_message_fields = {}
+database_path = "/code/app/homelabapi.db"
+dedup_fingerprints = {
+    "monit": ["service", "event", "host"],
+    "smokeping": ["target", "alertname"],
+    "uptimerobot": ["monitorID", "alertType"],
+}
+dedup_max_entries = 1000
+dedup_window = 0
+digest_bypass_priority = 1
+digest_max_batch = 20
+digest_max_delay = 60
+digest_windows = {}
+journal_enabled = False
+journal_max_age = 2592000
+journal_max_size = 268435456
+journal_path = "/code/app/journal"
+journal_segment_age = 86400
+journal_segment_size = 8388608
+max_body_size = 1048576
+max_concurrent_outputs = 10
+metrics_enabled = True
+outbox_enabled = False
+outbox_poll_interval = 0.1
+output_timeout = 10
+retry_base_delay = 5
+retry_max_age = 3600
+retry_max_attempts = 5
+retry_max_delay = 600
+smtp_idle_timeout = 60
+
+config_path = os.environ.get("HOMELABAPI_CONFIG", "/code/app/config.yaml")
+config_watch_interval = 5
+
+
+def read_configuration(path):
+    with open(path, mode="rt", encoding="utf-8") as file:
+        return yaml.safe_load(file)
+
+
+def parse_current_outputs(value):
+
+    if "," in value:
+        return [output.strip() for output in value.split(",")]
+    else:
+        if value == "all":
+            return all_outputs
+        else:
+            return [value]
 
-    app_settings = configuration["application"]
-    for key, value in app_settings.items():
-        match key:
-            case "api_name":
-                api_title = value
-            case "api_key":
-                app_api_key = value
-            case "current_outputs":
-                if "," in value:
-                    current_outputs = value.split(",")
-                else:
-                    if value == "all":
-                        current_outputs = all_outputs
-                    else:
-                        current_outputs = [value]
 
-    outputs = {}
-    output_settings = configuration["outputs"]
-    for key, value in output_settings.items():
-        match key:
-            case "discord":
-                outputs["discord"] = value
-            case "email":
-                outputs["email"] = value
-            case "gotify":
-                outputs["gotify"] = value
-            case "matrix":
-                outputs["matrix"] = value
-            case "ntfysh":
-                outputs["ntfysh"] = value
-            case "pushbullet":
-                outputs["pushbullet"] = value
-            case "pushover":
-                outputs["pushover"] = value
-            case "telegram":
-                outputs["telegram"] = value
-            case "webhook":
-                outputs["webhook"] = value
+def parse_outputs(output_settings):
+    return {
+        output: accounts
+        for output, accounts in output_settings.items()
+        if output in all_outputs
+    }
+
+
+configuration = read_configuration(config_path)
+
+app_settings = configuration["application"]
+for key, value in app_settings.items():
+    match key:
+        case "api_name":
+            api_title = value
+        case "circuit_error_rate":
+            circuit_error_rate = float(value)
+        case "circuit_failures":
+            circuit_failures = int(value)
+        case "circuit_open_time":
+            circuit_open_time = float(value)
+        case "circuit_window":
+            circuit_window = int(value)
+        case "config_watch_interval":
+            config_watch_interval = float(value)
+        case "database":
+            database_path = value
+        case "dedup_fingerprints":
+            dedup_fingerprints.update(
+                {
+                    endpoint: (fields.split(",") if isinstance(fields, str) else fields)
+                    for endpoint, fields in value.items()
+                }
+            )
+        case "dedup_max_entries":
+            dedup_max_entries = int(value)
+        case "dedup_window":
+            dedup_window = float(value)
+        case "digest_bypass_priority":
+            digest_bypass_priority = int(value)
+        case "digest_max_batch":
+            digest_max_batch = int(value)
+        case "digest_max_delay":
+            digest_max_delay = float(value)
+        case "digest_windows":
+            digest_windows = {name: float(window) for name, window in value.items()}
+        case "journal":
+            journal_enabled = bool(value)
+        case "journal_max_age":
+            journal_max_age = float(value)
+        case "journal_max_size":
+            journal_max_size = int(value)
+        case "journal_path":
+            journal_path = value
+        case "journal_segment_age":
+            journal_segment_age = float(value)
+        case "journal_segment_size":
+            journal_segment_size = int(value)
+        case "max_body_size":
+            max_body_size = int(value)
+        case "max_concurrent_outputs":
+            max_concurrent_outputs = int(value)
+        case "message_fields":
+            custom_message_fields = value
+        case "metrics":
+            metrics_enabled = bool(value)
+        case "outbox":
+            outbox_enabled = bool(value)
+        case "outbox_poll_interval":
+            outbox_poll_interval = float(value)
+        case "output_timeout":
+            output_timeout = float(value)
+        case "retry_base_delay":
+            retry_base_delay = float(value)
+        case "retry_max_age":
+            retry_max_age = float(value)
+        case "retry_max_attempts":
+            retry_max_attempts = int(value)
+        case "retry_max_delay":
+            retry_max_delay = float(value)
+        case "smtp_idle_timeout":
+            smtp_idle_timeout = int(value)
 
 app_dir = "app"
-api_version = "0.7.0"
+api_version = "0.8.0"
 
 api_description = "Welcome to " + api_title + "."
 input_success = "Success! Your input request was accepted by " + api_title
@@ -78,6 +225,7 @@ input_failure = "Failure! Your input request was NOT accepted by " + api_title
 
 # Endpoint Descriptions
 desc_healthchecks = "Receive a POST request from HealthChecks"
+desc_input_batch = "Receive many default endpoint inputs in one request, either as a JSON array or as newline-delimited JSON (NDJSON). The API key is sent once, in an X-API-Key header or an api_key query parameter."
 desc_input = "This is the default POST endpoint. This endpoint should be used if none of the service-specific endpoints or webhooks apply."
 desc_monit = "Receive a POST request from Monit"
 desc_smokeping = "Receive a POST request from SmokePing"
@@ -92,6 +240,9 @@ desc_radarr = "Receive a webhook from Radarr"
 desc_sonarr = "Receive a webhook from Sonarr"
 desc_synology = "Receive a webhook from a Synology NAS"
 desc_tailscale = "Receive a webhook from Tailscale"
+desc_journal = "Lists journaled notifications, newest first, with every attempt to deliver them. Filter by since and until (Unix time), endpoint, source and status, and pass the returned next value as before to get the following page. The API key is sent in an X-API-Key header or an api_key query parameter."
+desc_replay = "Sends stored notifications again through the current routing, templates and outputs, oldest first. Set store to journal (the default) or dead_letters, and filter by since and until (Unix time), endpoint, source, status (journal only) and output (dead letters only). The response is a JSON line for every notification as it's sent, followed by a summary line. The API key is sent in an X-API-Key header or an api_key query parameter."
+desc_status = "Shows the circuit breaker state and last error of every output account. The API key is sent in an X-API-Key header or an api_key query parameter."
 
 # Default Subjects
 subject_changedetectionio = "ChangeDetection.io"
@@ -171,7 +322,7 @@ tags_metadata = [
 
 
 class CommonModel(BaseModel):
-    api_key: str = Field(example=sample_api_key)
+    api_key: str = Field(default=None, example=sample_api_key)
     subject: str = Field(default=sample_subject, example=sample_subject)
     message: str = Field(example=sample_message)
     url: str = Field(default=None, example=sample_url)
@@ -307,12 +458,131 @@ class UptimeRobotModel(CommonModel):
         )
 
 
+# Message Fields
+#
+# The extra fields that the service endpoints add to the end of the message, in order.
+# Each field is given as (field, label, values to skip), and empty values are always
+# skipped. These can be replaced per endpoint with "message_fields" in config.yaml.
+message_fields = {
+    "healthchecks": [
+        ("name", "Name", ()),
+        ("status", "Status", ()),
+        ("tags", "Tags", ()),
+        ("time", "Time", ()),
+        ("uuid", "UUID", ()),
+    ],
+    "monit": [
+        ("action", "action", ()),
+        ("date", "date", ()),
+        ("description", "description", ()),
+        ("event", "event", ()),
+        ("host", "host", ()),
+        ("process_children", "process_children", ()),
+        ("process_cpu_percent", "process_cpu_percent", ()),
+        ("process_pid", "process_pid", ()),
+        ("process_memory", "process_memory", ()),
+        ("program_status", "program_status", ()),
+        ("service", "service", ()),
+    ],
+    "smokeping": [
+        ("alertname", "Alert Name", ()),
+        ("hostname", "Hostname", ()),
+        ("losspattern", "Loss Pattern", ()),
+        ("rtt", "RTT", ()),
+        ("target", "Target", ()),
+    ],
+    # UptimeRobot sends the literal placeholder when a value isn't available.
+    "uptimerobot": [
+        (field, field, ("*" + field + "*",))
+        for field in (
+            "alertDateTime",
+            "alertDetails",
+            "alertDuration",
+            "alertType",
+            "alertTypeFriendlyName",
+            "monitorAlertContacts",
+            "monitorFriendlyName",
+            "monitorID",
+            "monitorURL",
+            "sslExpiryDate",
+            "sslExpiryDaysLeft",
+        )
+    ],
+}
+
+# Endpoints that move the URL into the message body, ahead of the fields.
+message_url_endpoints = ("healthchecks", "smokeping", "uptimerobot")
+
+
+class FieldFormatter:
+    __slots__ = ("fields", "url_in_message")
+
+    def __init__(self, fields, url_in_message):
+        # Values are compared as the text they'd be rendered as, so a skip of 0 in
+        # config.yaml matches a field that arrived as "0" and the other way round.
+        self.fields = tuple(
+            (
+                field,
+                label + ": ",
+                frozenset(
+                    str(value) for value in ((skip,) if isinstance(skip, str) else skip)
+                )
+                | {""},
+            )
+            for field, label, skip in fields
+        )
+        self.url_in_message = url_in_message
+
+    def render(self, payload):
+
+        parts = [payload.message, "\n\n"]
+
+        if self.url_in_message and payload.url:
+            parts += [payload.url, "\n\n"]
+            payload.url = ""
+
+        for field, prefix, skip in self.fields:
+            value = getattr(payload, field, None)
+            if value is not None and (value := str(value)) not in skip:
+                parts += [prefix, value, "\n"]
+
+        payload.message = "".join(parts)
+
+
+def custom_fields(fields):
+
+    # Fields from config.yaml can be just a field name, or a mapping with "field" and
+    # optional "label" and "skip" keys.
+    for field in fields:
+        if isinstance(field, str):
+            yield field, field, ()
+        else:
+            yield field["field"], field.get("label", field["field"]), field.get(
+                "skip", ()
+            )
+
+
+field_formatters = {
+    endpoint: FieldFormatter(
+        (
+            custom_fields(custom_message_fields[endpoint])
+            if endpoint in custom_message_fields
+            else fields
+        ),
+        endpoint in message_url_endpoints,
+    )
+    for endpoint, fields in message_fields.items()
+}
+
+
 app = FastAPI(
     version="v" + api_version,
     title=api_title,
     description=api_description,
     docs_url=None,
     redoc_url=None,
+    openapi_url=None,
+    default_response_class=ORJSONResponse if orjson is not None else JSONResponse,
     openapi_tags=tags_metadata,
     swagger_ui_default_parameters={
         "dom_id": "#swagger-ui",
@@ -322,1067 +592,3852 @@ app = FastAPI(
         "showCommonExtensions": True,
     },
 )
-app.mount("/assets", StaticFiles(directory="assets"), name="assets")
-
-templates = Jinja2Templates(directory="templates")
 
 
-@app.head(
-    "/",
-    tags=["Documentation"],
-    summary="This is here for services that ping the API using HEAD, such as UptimeRobot.",
-    description="This is here for services that ping the API using HEAD, such as UptimeRobot.",
-    include_in_schema=False,
-)
-@app.get(
-    "/",
-    tags=["Documentation"],
-    summary="Displays the primary documentation (OpenAPI/Swagger) -- You're viewing this right now!",
-    description="Displays the primary documentation (OpenAPI/Swagger) -- You're viewing this right now!",
-    include_in_schema=False,
-)
-async def show_docs(request: Request):
-    return templates.TemplateResponse(
-        "index.html", {"request": request, "api_title": api_title}
-    )
+# The documentation assets are a few megabytes of JavaScript and CSS, so they're served
+# compressed when the browser allows it. Pages link to them with the hash of their
+# contents in the URL, which lets browsers cache them for good, and an unchanged asset
+# that's asked for again gets a 304 without the file being touched.
+class Asset:
+    __slots__ = ("path", "media_type", "version", "stat", "encoded")
 
+    def __init__(self, path):
+        self.path = path
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.stat = os.stat(path)
+        self.encoded = {}
 
-@app.get(
-    "/docs",
-    tags=["Documentation"],
-    summary="Redirects to /",
-    description="Redirects to /",
-    include_in_schema=False,
-)
-def redirect_docs():
-    response = RedirectResponse(url="/")
-    return response
+        with open(path, mode="rb") as file:
+            self.version = hashlib.sha256(file.read()).hexdigest()[:16]
 
+    def compress(self):
 
-@app.get(
-    "/redoc",
-    tags=["Documentation"],
-    summary="Displays the alternate documentation (Redoc)",
-    description="Displays the alternate documentation (Redoc)",
-    include_in_schema=False,
-)
-async def redoc_html():
-    return get_redoc_html(
-        openapi_url=app.openapi_url,
-        title=api_title,
-        redoc_js_url="/assets/redoc.standalone.js",
-        redoc_favicon_url="/assets/favicon.png",
-    )
+        with open(self.path, mode="rb") as file:
+            data = file.read()
 
+        encoders = {"gzip": functools.partial(gzip.compress, compresslevel=9)}
 
-@app.get(
-    app.swagger_ui_oauth2_redirect_url,
-    tags=["System"],
-    summary="OAuth redirect thingie",
-    description="OAuth redirect thingie",
-    include_in_schema=False,
-)
-async def swagger_ui_redirect():
-    return get_swagger_ui_oauth2_redirect_html()
+        if brotli is not None:
+            encoders["br"] = brotli.compress
 
+        encodings = {}
 
-@app.post(
-    "/input",
-    summary=desc_input,
-    description=desc_input,
-    tags=["Default Endpoint"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def default_input(payload: InputModel):
+        for encoding, encode in encoders.items():
 
-    if payload.api_key == app_api_key:
+            encoded = encode(data)
 
-        try:
+            # Images and the like are already compressed and are left alone.
+            if len(encoded) < len(data) * 0.9:
+                encodings[encoding] = encoded
 
-            send_output(
-                payload.json,
-                payload.subject,
-                payload.message,
-                payload.url,
-                payload.priority,
-            )
-            to_return = {"result": input_success}
+        # Requests read the encodings while this runs in a thread, so they're swapped
+        # in all at once rather than added one by one.
+        self.encoded = encodings
 
-        except Exception:
+    def negotiate(self, accept_encoding):
 
-            to_return = {"result": input_failure}
+        accepted = set()
 
-        return to_return
+        for item in accept_encoding.split(","):
 
-    else:
+            encoding, _, quality = item.partition(";")
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+            try:
+                if float(quality.strip().removeprefix("q=") or 1) > 0:
+                    accepted.add(encoding.strip().lower())
+            except ValueError:
+                continue
 
+        encoded = self.encoded
 
-@app.post(
-    "/healthchecks",
-    summary=desc_healthchecks,
-    description=desc_healthchecks,
-    tags=["Service Endpoints"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-def healthchecks(payload: HealthChecksModel):
+        return min(
+            (encoding for encoding in encoded if encoding in accepted),
+            key=lambda encoding: len(encoded[encoding]),
+            default=None,
+        )
 
-    if payload.api_key == app_api_key:
 
-        try:
-            payload.message += "\n\n"
+assets = {
+    name: Asset(os.path.join("assets", name))
+    for name in sorted(os.listdir("assets"))
+    if os.path.isfile(os.path.join("assets", name))
+}
 
-            try:
-                if payload.url and payload.url != "":
-                    payload.message += payload.url + "\n\n"
-                    payload.url = ""
-            except:
-                pass
 
-            try:
-                if payload.name and payload.name != "":
-                    payload.message += "Name: " + payload.name + "\n"
-            except:
-                pass
+def asset_url(name):
+    return "/assets/" + name + "?v=" + assets[name].version
 
-            try:
-                if payload.status and payload.status != "":
-                    payload.message += "Status: " + payload.status + "\n"
-            except:
-                pass
 
-            try:
-                if payload.tags and payload.tags != "":
-                    payload.message += "Tags: " + payload.tags + "\n"
-            except:
-                pass
+def compress_assets():
 
-            try:
-                if payload.time and payload.time != "":
-                    payload.message += "Time: " + payload.time + "\n"
-            except:
-                pass
+    # Brotli at its best quality takes a few seconds for the larger assets, so this
+    # runs in a thread and assets are sent uncompressed until it's done.
+    for asset in assets.values():
+        asset.compress()
 
-            try:
-                if payload.uuid and payload.uuid != "":
-                    payload.message += "UUID: " + payload.uuid + "\n"
-            except:
-                pass
 
-            send_output(
-                payload.json(),
-                payload.subject,
-                payload.message,
-                payload.url,
-                payload.priority,
-            )
-            to_return = {"result": input_success}
+def etag_matches(if_none_match, etag):
 
-        except Exception:
+    if if_none_match is None:
+        return False
 
-            to_return = {"result": input_failure}
+    return if_none_match.strip() == "*" or etag in (
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    )
 
-        return to_return
 
-    else:
+templates = Jinja2Templates(directory="templates")
+templates.env.globals["asset_url"] = asset_url
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
 
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-@app.post(
-    "/monit",
-    summary=desc_monit,
-    description=desc_monit,
-    tags=["Service Endpoints"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def monit(payload: MonitModel):
 
-    if payload.api_key == app_api_key:
+class Histogram:
+    __slots__ = ("counts", "sum")
 
-        try:
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets) + 1)
+        self.sum = 0.0
 
-            payload.message += "\n\n"
+    def observe(self, value):
+        self.counts[bisect.bisect_left(latency_buckets, value)] += 1
+        self.sum += value
 
-            try:
-                if payload.action and payload.action != "":
-                    payload.message += "action: " + payload.action + "\n"
-            except:
-                pass
 
-            try:
-                if payload.date and payload.date != "":
-                    payload.message += "date: " + payload.date + "\n"
-            except:
-                pass
+# Everything is updated from the event loop thread, so plain counters are enough and
+# recording a request costs a couple of dictionary updates.
+class Metrics:
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.request_latency = collections.defaultdict(Histogram)
+        self.requests_in_flight = 0
+        self.auth_failures = collections.Counter()
+        self.output_sends = collections.Counter()
+        self.output_latency = collections.defaultdict(Histogram)
+        self.outputs_in_flight = 0
+        self.retries_pending = 0
 
-            try:
-                if payload.description and payload.description != "":
-                    payload.message += "description: " + payload.description + "\n"
-            except:
-                pass
+    def render(self):
 
-            try:
-                if payload.event and payload.event != "":
-                    payload.message += "event: " + payload.event + "\n"
-            except:
-                pass
+        lines = []
 
-            try:
-                if payload.host and payload.host != "":
-                    payload.message += "host: " + payload.host + "\n"
-            except:
-                pass
+        add_counter(
+            lines,
+            "homelabapi_requests_total",
+            "Requests received, by route and response status.",
+            self.requests,
+            ("route", "status"),
+        )
+        add_histogram(
+            lines,
+            "homelabapi_request_duration_seconds",
+            "Time taken to answer requests, by route.",
+            self.request_latency,
+            ("route",),
+        )
+        add_gauge(
+            lines,
+            "homelabapi_requests_in_flight",
+            "Requests currently being answered.",
+            self.requests_in_flight,
+        )
+        add_counter(
+            lines,
+            "homelabapi_auth_failures_total",
+            "Requests rejected because of an invalid API key, by endpoint.",
+            self.auth_failures,
+            ("endpoint",),
+        )
+        add_counter(
+            lines,
+            "homelabapi_output_sends_total",
+            "Sends to output accounts, by result.",
+            self.output_sends,
+            ("output", "account", "result"),
+        )
+        add_histogram(
+            lines,
+            "homelabapi_output_duration_seconds",
+            "Time taken by sends to output accounts.",
+            self.output_latency,
+            ("output", "account"),
+        )
+        add_gauge(
+            lines,
+            "homelabapi_output_sends_in_flight",
+            "Sends to output accounts currently in progress.",
+            self.outputs_in_flight,
+        )
+        add_gauge(
+            lines,
+            "homelabapi_retries_pending",
+            "Failed sends waiting to be retried.",
+            self.retries_pending,
+        )
+        add_gauge(
+            lines,
+            "homelabapi_outbox_queued",
+            "Notifications waiting in the outbox.",
+            outbox.size() if outbox is not None else 0,
+        )
+        add_gauge(
+            lines,
+            "homelabapi_digest_queued",
+            "Notifications being held for a digest.",
+            coalescer.size() if coalescer is not None else 0,
+        )
 
-            try:
-                if payload.process_children and payload.process_children != "":
-                    payload.message += (
-                        "process_children: " + payload.process_children + "\n"
-                    )
-            except:
-                pass
+        return "\n".join(lines) + "\n"
 
-            try:
-                if payload.process_cpu_percent and payload.process_cpu_percent != "":
-                    payload.message += (
-                        "process_cpu_percent: " + payload.process_cpu_percent + "\n"
-                    )
-            except:
-                pass
 
-            try:
-                if payload.process_pid and payload.process_pid != "":
-                    payload.message += "process_pid: " + payload.process_pid + "\n"
-            except:
-                pass
+def format_labels(names, values):
+    return ",".join(
+        name
+        + '="'
+        + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in zip(names, values)
+    )
 
-            try:
-                if payload.process_memory and payload.process_memory != "":
-                    payload.message += (
-                        "process_memory: " + payload.process_memory + "\n"
-                    )
-            except:
-                pass
 
-            try:
-                if payload.program_status and payload.program_status != "":
-                    payload.message += (
-                        "program_status: " + payload.program_status + "\n"
-                    )
-            except:
-                pass
+def add_counter(lines, name, description, counter, label_names):
 
-            try:
-                if payload.service and payload.service != "":
-                    payload.message += "service: " + payload.service + "\n"
-            except:
-                pass
+    lines.append("# HELP " + name + " " + description)
+    lines.append("# TYPE " + name + " counter")
 
-            send_output(payload.json(), payload.subject, payload.message, "", "")
-            to_return = {"result": input_success}
+    for labels, value in counter.items():
+        lines.append(
+            name + "{" + format_labels(label_names, labels) + "} " + str(value)
+        )
 
-        except Exception:
 
-            to_return = {"result": input_failure}
+def add_gauge(lines, name, description, value):
 
-        return to_return
+    lines.append("# HELP " + name + " " + description)
+    lines.append("# TYPE " + name + " gauge")
+    lines.append(name + " " + str(value))
 
-    else:
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+def add_histogram(lines, name, description, histograms, label_names):
 
+    lines.append("# HELP " + name + " " + description)
+    lines.append("# TYPE " + name + " histogram")
 
-@app.post(
-    "/smokeping",
-    summary=desc_smokeping,
-    description=desc_smokeping,
-    tags=["Service Endpoints"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-def smokeping(payload: SmokePingModel):
+    for labels, histogram in histograms.items():
 
-    if payload.api_key == app_api_key:
+        prefix = format_labels(label_names, labels) + ","
+        total = 0
 
-        try:
-            payload.message += "\n\n"
+        for bound, count in zip(latency_buckets + ("+Inf",), histogram.counts):
+            total += count
+            lines.append(
+                name + "_bucket{" + prefix + 'le="' + str(bound) + '"} ' + str(total)
+            )
 
-            try:
-                if payload.url and payload.url != "":
-                    payload.message += payload.url + "\n\n"
-                    payload.url = ""
-            except:
-                pass
+        lines.append(name + "_sum{" + prefix[:-1] + "} " + str(histogram.sum))
+        lines.append(name + "_count{" + prefix[:-1] + "} " + str(total))
 
-            try:
-                if payload.alertname and payload.alertname != "":
-                    payload.message += "Alert Name: " + payload.alertname + "\n"
-            except:
-                pass
 
-            try:
-                if payload.hostname and payload.hostname != "":
-                    payload.message += "Hostname: " + payload.hostname + "\n"
-            except:
-                pass
+metrics = Metrics()
 
-            try:
-                if payload.losspattern and payload.losspattern != "":
-                    payload.message += "Loss Pattern: " + payload.losspattern + "\n"
-            except:
-                pass
 
-            try:
-                if payload.rtt and payload.rtt != "":
-                    payload.message += "RTT: " + payload.rtt + "\n"
-            except:
-                pass
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.route_paths = None
 
-            try:
-                if payload.target and payload.target != "":
-                    payload.message += "Target: " + payload.target + "\n"
-            except:
-                pass
+    async def __call__(self, scope, receive, send):
 
-            send_output(
-                payload.json(),
-                payload.subject,
-                payload.message,
-                payload.url,
-                payload.priority,
-            )
-            to_return = {"result": input_success}
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-        except Exception:
+        response_status = status.HTTP_500_INTERNAL_SERVER_ERROR
 
-            to_return = {"result": input_failure}
+        async def send_with_status(message):
+            nonlocal response_status
+            if message["type"] == "http.response.start":
+                response_status = message["status"]
+            await send(message)
 
-        return to_return
+        started = time.perf_counter()
+        metrics.requests_in_flight += 1
 
-    else:
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.requests_in_flight -= 1
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+            route = self.route_path(scope)
 
+            metrics.requests[(route, response_status)] += 1
+            metrics.request_latency[(route,)].observe(time.perf_counter() - started)
 
-@app.post(
-    "/uptimerobot",
-    summary=desc_uptimerobot,
-    description=desc_uptimerobot,
-    tags=["Service Endpoints"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def uptimerobot(payload: UptimeRobotModel):
+    def route_path(self, scope):
 
-    if payload.api_key == app_api_key:
+        # Routes are labelled with their path template, which keeps API keys in
+        # webhook URLs out of the metrics. Several routes can share an endpoint (such
+        # as HEAD / and /healthz), so the one whose path matched is picked out.
+        if self.route_paths is None:
+            self.route_paths = collections.defaultdict(list)
+            for route in app.routes:
+                endpoint = getattr(route, "endpoint", getattr(route, "app", None))
+                self.route_paths[endpoint].append(route)
 
-        try:
+        if "endpoint" not in scope:
+            return self.targeted_route_path(scope)
 
-            payload.message += "\n\n"
+        routes = self.route_paths.get(scope["endpoint"], ())
 
-            try:
-                if payload.url and payload.url != "":
-                    payload.message += payload.url + "\n\n"
-                    payload.url = ""
-            except:
-                pass
+        if len(routes) == 1:
+            return routes[0].path
 
-            try:
-                if payload.alertDateTime and payload.alertDateTime != "*alertDateTime*":
-                    payload.message += "alertDateTime: " + payload.alertDateTime + "\n"
-            except:
-                pass
+        for route in routes:
+            if route.path_regex.match(scope["path"]):
+                return route.path
 
-            try:
-                if payload.alertDetails and payload.alertDetails != "*alertDetails*":
-                    payload.message += "alertDetails: " + payload.alertDetails + "\n"
-            except:
-                pass
+        return "unmatched"
 
-            try:
-                if payload.alertDuration and payload.alertDuration != "*alertDuration*":
-                    payload.message += "alertDuration: " + payload.alertDuration + "\n"
-            except:
-                pass
+    def targeted_route_path(self, scope):
 
-            try:
-                if payload.alertType and payload.alertType != "*alertType*":
-                    payload.message += "alertType: " + payload.alertType + "\n"
-            except:
-                pass
+        # Requests turned away before routing, such as by the API key check, are
+        # labelled with the route they were aimed at, preferring one that also takes
+        # their method.
+        partial = None
 
-            try:
-                if (
-                    payload.alertTypeFriendlyName
-                    and payload.alertTypeFriendlyName != "*alertTypeFriendlyName*"
-                ):
-                    payload.message += (
-                        "alertTypeFriendlyName: " + payload.alertTypeFriendlyName + "\n"
-                    )
-            except:
-                pass
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+            if match == Match.PARTIAL and partial is None:
+                partial = route.path
 
-            try:
-                if (
-                    payload.monitorAlertContacts
-                    and payload.monitorAlertContacts != "*monitorAlertContacts*"
-                ):
-                    payload.message += (
-                        "monitorAlertContacts: " + payload.monitorAlertContacts + "\n"
-                    )
-            except:
-                pass
+        return partial or "unmatched"
 
-            try:
-                if (
-                    payload.monitorFriendlyName
-                    and payload.monitorFriendlyName != "*monitorFriendlyName*"
-                ):
-                    payload.message += (
-                        "monitorFriendlyName: " + payload.monitorFriendlyName + "\n"
-                    )
-            except:
-                pass
 
-            try:
-                if payload.monitorID and payload.monitorID != "*monitorID*":
-                    payload.message += "monitorID: " + payload.monitorID + "\n"
-            except:
-                pass
+ApiKey = collections.namedtuple("ApiKey", ("name", "key", "scopes", "endpoints"))
 
-            try:
-                if payload.monitorURL and payload.monitorURL != "*monitorURL*":
-                    payload.message += "monitorURL: " + payload.monitorURL + "\n"
-            except:
-                pass
+api_key_scopes = ("admin", "send")
 
-            try:
-                if payload.sslExpiryDate and payload.sslExpiryDate != "*sslExpiryDate*":
-                    payload.message += "sslExpiryDate: " + payload.sslExpiryDate + "\n"
-            except:
-                pass
+# The input endpoints that take their API key from a field of the JSON body, and the
+# webhooks that take it from the last segment of their path. Every endpoint also
+# accepts an X-API-Key header or an api_key query parameter.
+body_key_endpoints = ("input", "healthchecks", "monit", "smokeping", "uptimerobot")
+path_key_endpoints = (
+    "changedetectionio",
+    "headphones",
+    "homeassistant",
+    "lazylibrarian",
+    "radarr",
+    "sonarr",
+    "synology",
+    "tailscale",
+)
+header_key_endpoints = {
+    "input/batch": "send",
+    "journal": "admin",
+    "replay": "admin",
+    "status": "admin",
+}
 
-            try:
-                if (
-                    payload.sslExpiryDaysLeft
-                    and payload.sslExpiryDaysLeft != "*sslExpiryDaysLeft*"
-                ):
-                    payload.message += (
-                        "sslExpiryDaysLeft: " + payload.sslExpiryDaysLeft + "\n"
-                    )
-            except:
-                pass
 
-            send_output(
-                payload.json(),
-                payload.subject,
-                payload.message,
-                payload.url,
-                payload.priority,
-            )
-            to_return = {"result": input_success}
+def parse_api_keys(app_settings):
 
-        except Exception:
+    api_key = app_settings["api_key"]
 
-            to_return = {"result": input_failure}
+    if not isinstance(api_key, str) or api_key == "":
+        raise ValueError("application.api_key must be set")
 
-        return to_return
+    # The original api_key can do everything, extra keys can be limited to some scopes
+    # and endpoints.
+    api_keys = [ApiKey("api_key", api_key, frozenset(api_key_scopes), None)]
 
-    else:
+    for entry in app_settings.get("api_keys") or []:
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+        key = entry.get("key")
+        scopes = entry.get("scopes", ["send"])
+        endpoints = entry.get("endpoints")
 
+        if not isinstance(key, str) or key == "":
+            raise ValueError("Every entry in api_keys needs a key")
 
-@app.post(
-    "/changedetectionio/{api_key}",
-    summary=desc_changedetectionio,
-    description=desc_changedetectionio,
-    tags=["Service Webhooks"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def webhook_changedetectionio(api_key: str, payload: Request):
+        if isinstance(scopes, str):
+            scopes = [scope.strip() for scope in scopes.split(",")]
 
-    if api_key == app_api_key:
+        if isinstance(endpoints, str):
+            endpoints = [endpoint.strip() for endpoint in endpoints.split(",")]
 
-        try:
+        for scope in scopes:
+            if scope not in api_key_scopes:
+                raise ValueError("Unknown scope in api_keys: " + scope)
 
-            result = await payload.json()
-            send_output(
-                result,
-                result["title"],
-                result["message"].removesuffix("\n---\n\n---"),
-                "",
-                0,
+        api_keys.append(
+            ApiKey(
+                entry.get("name", "api_keys[" + str(len(api_keys) - 1) + "]"),
+                key,
+                frozenset(scopes),
+                frozenset(endpoints) if endpoints is not None else None,
             )
-            return {"result": input_success}
+        )
 
-        except Exception:
+    keys_by_hash = {hash_api_key(api_key.key): api_key for api_key in api_keys}
 
-            return {"result": input_failure}
+    if len(keys_by_hash) != len(api_keys):
+        raise ValueError("The same key is used more than once in api_keys")
 
-    else:
+    return keys_by_hash
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
 
+def hash_api_key(key):
+    return hashlib.sha256(key.encode()).digest()
 
-@app.post(
-    "/headphones/{api_key}",
-    summary=desc_headphones,
-    description=desc_headphones,
-    tags=["Service Webhooks"],
+
+def find_api_key(presented):
+
+    if not presented:
+        return None
+
+    # Keys are found by their hash, so how long the lookup takes doesn't depend on how
+    # much of a key was guessed right, and the match is confirmed in constant time.
+    api_key = dispatch_table.api_keys.get(hash_api_key(presented))
+
+    if api_key is not None and hmac.compare_digest(
+        api_key.key.encode(), presented.encode()
+    ):
+        return api_key
+
+    return None
+
+
+def key_allows(api_key, endpoint, scope):
+    return (
+        api_key is not None
+        and scope in api_key.scopes
+        and (api_key.endpoints is None or endpoint in api_key.endpoints)
+    )
+
+
+def protected_endpoint(path):
+
+    parts = path.strip("/").split("/")
+    name = "/".join(parts)
+
+    if name in header_key_endpoints:
+        return name, header_key_endpoints[name], "header"
+    elif len(parts) == 1 and parts[0] in body_key_endpoints:
+        return parts[0], "send", "body"
+    elif len(parts) == 2 and parts[0] in path_key_endpoints:
+        return parts[0], "send", "path"
+    else:
+        return None, None, None
+
+
+async def send_json(send, status_code, content):
+
+    body = json_dumps(content)
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+# Requests are authenticated before FastAPI reads or validates anything, so a request
+# with a bad key costs a header lookup (or for the body endpoints, one fast JSON
+# parse) rather than a full model validation.
+class AuthMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        endpoint, api_scope, location = protected_endpoint(scope["path"])
+
+        if endpoint is None:
+            await self.app(scope, receive, send)
+            return
+
+        presented = None
+
+        if location == "path":
+            presented = scope["path"].rstrip("/").rsplit("/", 1)[1]
+
+        if presented is None:
+            presented = dict(scope["headers"]).get(b"x-api-key", b"").decode() or None
+
+        if presented is None:
+            query = urllib.parse.parse_qs(scope["query_string"].decode())
+            presented = query.get("api_key", [None])[0]
+
+        if presented is None and location == "body":
+
+            try:
+                body = await read_request_body(receive)
+            except BodyTooLarge as error:
+                await send_json(
+                    send,
+                    status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    {"result": input_failure, "error": str(error)},
+                )
+                return
+
+            try:
+                fields = json_loads(body)
+            except ValueError:
+                fields = None
+
+            if isinstance(fields, dict) and isinstance(fields.get("api_key"), str):
+                presented = fields["api_key"]
+
+            receive = replay_body(body, receive)
+
+        api_key = find_api_key(presented)
+
+        if api_key is None:
+            metrics.auth_failures[(endpoint,)] += 1
+            await send_json(
+                send,
+                status.HTTP_401_UNAUTHORIZED,
+                {
+                    "result": "Invalid API Key ("
+                    + str(status.HTTP_401_UNAUTHORIZED)
+                    + ")"
+                },
+            )
+            return
+
+        if not key_allows(api_key, endpoint, api_scope):
+            metrics.auth_failures[(endpoint,)] += 1
+            await send_json(
+                send,
+                status.HTTP_403_FORBIDDEN,
+                {
+                    "result": "API Key not allowed here ("
+                    + str(status.HTTP_403_FORBIDDEN)
+                    + ")"
+                },
+            )
+            return
+
+        scope.setdefault("state", {})["api_key"] = api_key.name
+
+        await self.app(scope, receive, send)
+
+
+async def read_request_body(receive):
+
+    body = bytearray()
+
+    while True:
+
+        message = await receive()
+        body += message.get("body", b"")
+
+        if len(body) > max_body_size:
+            raise BodyTooLarge(
+                "Request body is larger than " + str(max_body_size) + " bytes"
+            )
+
+        if not message.get("more_body", False):
+            return bytes(body)
+
+
+def replay_body(body, receive):
+
+    replayed = False
+
+    async def receive_body():
+
+        nonlocal replayed
+
+        if replayed:
+            return await receive()
+
+        replayed = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return receive_body
+
+
+app.add_middleware(AuthMiddleware)
+
+if metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+
+
+# Monitors such as UptimeRobot ping the API every few seconds, so liveness checks
+# answer straight away without rendering anything.
+@app.head(
+    "/",
+    tags=["Documentation"],
+    summary="This is here for services that ping the API using HEAD, such as UptimeRobot.",
+    description="This is here for services that ping the API using HEAD, such as UptimeRobot.",
+    include_in_schema=False,
+)
+@app.head("/healthz", include_in_schema=False)
+@app.get("/healthz", include_in_schema=False)
+async def show_health():
+    return PlainTextResponse("OK")
+
+
+@functools.lru_cache(maxsize=4)
+def render_index(title):
+    return templates.get_template("index.html").render(api_title=title).encode()
+
+
+@app.get(
+    "/",
+    tags=["Documentation"],
+    summary="Displays the primary documentation (OpenAPI/Swagger) -- You're viewing this right now!",
+    description="Displays the primary documentation (OpenAPI/Swagger) -- You're viewing this right now!",
+    include_in_schema=False,
+)
+async def show_docs():
+    return HTMLResponse(render_index(api_title))
+
+
+# The schema only changes with the code, so it's generated and encoded once at startup
+# rather than on the first docs page load after a restart.
+openapi_json = None
+
+
+@app.get("/openapi.json", include_in_schema=False)
+async def show_openapi():
+    return Response(openapi_json, media_type="application/json")
+
+
+@app.on_event("startup")
+def build_openapi():
+
+    global openapi_json
+
+    openapi_json = json_dumps(app.openapi())
+
+
+@app.get(
+    "/docs",
+    tags=["Documentation"],
+    summary="Redirects to /",
+    description="Redirects to /",
+    include_in_schema=False,
+)
+def redirect_docs():
+    response = RedirectResponse(url="/")
+    return response
+
+
+@app.get(
+    "/redoc",
+    tags=["Documentation"],
+    summary="Displays the alternate documentation (Redoc)",
+    description="Displays the alternate documentation (Redoc)",
+    include_in_schema=False,
+)
+async def redoc_html():
+    return get_redoc_html(
+        openapi_url="/openapi.json",
+        title=api_title,
+        redoc_js_url=asset_url("redoc.standalone.js"),
+        redoc_favicon_url=asset_url("favicon.png"),
+    )
+
+
+@app.head("/assets/{name}", include_in_schema=False)
+@app.get("/assets/{name}", include_in_schema=False)
+async def serve_asset(name: str, request: Request):
+
+    asset = assets.get(name)
+
+    if asset is None:
+        return PlainTextResponse("Not Found", status_code=status.HTTP_404_NOT_FOUND)
+
+    encoding = asset.negotiate(request.headers.get("Accept-Encoding", ""))
+    etag = '"' + asset.version + ("-" + encoding if encoding else "") + '"'
+
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": (
+            "public, max-age=31536000, immutable"
+            if request.query_params.get("v") == asset.version
+            else "no-cache"
+        ),
+    }
+
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+        return Response(
+            b"" if request.method == "HEAD" else asset.encoded[encoding],
+            media_type=asset.media_type,
+            headers={
+                **headers,
+                "Content-Length": str(len(asset.encoded[encoding])),
+            },
+        )
+
+    return FileResponse(
+        asset.path,
+        media_type=asset.media_type,
+        headers=headers,
+        stat_result=asset.stat,
+        method=request.method,
+    )
+
+
+@app.get(
+    app.swagger_ui_oauth2_redirect_url,
+    tags=["System"],
+    summary="OAuth redirect thingie",
+    description="OAuth redirect thingie",
+    include_in_schema=False,
+)
+async def swagger_ui_redirect():
+    return get_swagger_ui_oauth2_redirect_html()
+
+
+@app.get(
+    "/metrics",
+    tags=["System"],
+    summary="Metrics in the Prometheus text format",
+    description="Metrics in the Prometheus text format",
+    include_in_schema=False,
+)
+async def show_metrics():
+
+    if not metrics_enabled:
+        return PlainTextResponse("", status_code=status.HTTP_404_NOT_FOUND)
+
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.head("/readyz", include_in_schema=False)
+@app.get("/readyz", include_in_schema=False)
+async def show_readiness():
+
+    # Readiness is worked out from what the circuit breakers already know, rather
+    # than by contacting every provider on each probe. Only counts are shown, as the
+    # endpoint doesn't need an API key.
+    circuits = collections.Counter(
+        get_circuit_breaker(destination.output, destination.account).state
+        for destination in configured_destinations(dispatch_table)
+    )
+    ready = not circuits or circuits["closed"] + circuits["half_open"] > 0
+
+    return JSONResponse(
+        {
+            "ready": ready,
+            "delivering": outbox is None or outbox.leading,
+            "circuits": {
+                state: circuits[state] for state in ("closed", "half_open", "open")
+            },
+            "outbox": outbox.size() if outbox is not None else None,
+        },
+        status_code=(
+            status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+    )
+
+
+@app.get(
+    "/status",
+    tags=["System"],
+    summary=desc_status,
+    description=desc_status,
+    include_in_schema=True,
+)
+async def show_status():
+
+    # With several worker processes only the one delivering from the outbox has
+    # breaker state worth showing.
+    return {
+        "process": os.getpid(),
+        "delivering": outbox is None or outbox.leading,
+        "outputs": [
+            get_circuit_breaker(destination.output, destination.account).status(
+                destination.output, destination.account.get("name", "")
+            )
+            for destination in configured_destinations(dispatch_table)
+        ],
+    }
+
+
+@app.get(
+    "/journal",
+    tags=["System"],
+    summary=desc_journal,
+    description=desc_journal,
+    include_in_schema=True,
+)
+async def show_journal(
+    since: float = None,
+    until: float = None,
+    endpoint: str = None,
+    source: str = None,
+    entry_status: str = Query(None, alias="status"),
+    before: int = None,
+    limit: int = 50,
+):
+
+    if journal is None:
+        return JSONResponse(
+            {"result": "failure", "error": "The journal isn't enabled"},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+
+    limit = max(1, min(limit, 500))
+    rows = journal.query(
+        since, until, endpoint, source, entry_status, before=before, limit=limit
+    )
+    attempts = journal.attempts([id for _, id, _, _, _ in rows])
+    entries = []
+
+    for seq, id, state, segment, offset in rows:
+
+        # The leader may have pruned the segment since the index was read.
+        try:
+            entry = journal.read(segment, offset)
+        except FileNotFoundError:
+            continue
+
+        del entry["type"]
+        entry["seq"] = seq
+        entry["status"] = state
+        entry["attempts"] = attempts[id]
+        entries.append(entry)
+
+    return {
+        "entries": entries,
+        "next": rows[-1][0] if len(rows) == limit else None,
+    }
+
+
+@app.post(
+    "/replay",
+    tags=["System"],
+    summary=desc_replay,
+    description=desc_replay,
+    include_in_schema=True,
+)
+async def replay_stored(
+    store: str = "journal",
+    since: float = None,
+    until: float = None,
+    endpoint: str = None,
+    source: str = None,
+    entry_status: str = Query(None, alias="status"),
+    output: str = None,
+):
+
+    if store == "journal":
+
+        if journal is None:
+            return JSONResponse(
+                {"result": "failure", "error": "The journal isn't enabled"},
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+
+        pages = journal_pages(since, until, endpoint, source, entry_status)
+
+    elif store == "dead_letters":
+        pages = dead_letter_pages(since, until, endpoint, source, output)
+    else:
+        return JSONResponse(
+            {"result": "failure", "error": "store must be journal or dead_letters"},
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+
+    return StreamingResponse(replay(pages), media_type="application/x-ndjson")
+
+
+@app.post(
+    "/input",
+    summary=desc_input,
+    description=desc_input,
+    tags=["Default Endpoint"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def default_input(payload: InputModel, response: Response):
+
+    try:
+
+        response.status_code = await send_output(
+            payload.json(exclude={"api_key"}),
+            payload.subject,
+            payload.message,
+            payload.url,
+            payload.priority,
+            endpoint="input",
+        )
+        to_return = {"result": input_success}
+
+    except Exception:
+
+        to_return = {"result": input_failure}
+
+    return to_return
+
+
+@app.post(
+    "/input/batch",
+    summary=desc_input_batch,
+    description=desc_input_batch,
+    tags=["Default Endpoint"],
     status_code=status.HTTP_200_OK,
     include_in_schema=True,
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "type": "array",
+                        "items": {"$ref": "#/components/schemas/InputModel"},
+                    }
+                },
+                "application/x-ndjson": {
+                    "schema": {"$ref": "#/components/schemas/InputModel"}
+                },
+            },
+            "required": True,
+        }
+    },
 )
-async def webhook_headphones(api_key: str, payload: Request):
+async def batch_input(payload: Request, response: Response):
+
+    if payload.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+        items = read_ndjson(payload)
+    else:
+        items = read_json_array(payload)
+
+    results = []
+    deliveries = []
+
+    try:
+
+        # Items are validated and handed off as they arrive, so a long NDJSON stream
+        # is already being sent while the rest of it is still being uploaded.
+        async for item in items:
+
+            try:
+
+                if isinstance(item, bytes):
+                    item = json_loads(item)
+
+                entry = InputModel.parse_obj(item)
+
+                # The request itself has already been let in, but an item that brings
+                # its own key is still held to it.
+                if entry.api_key is not None and not key_allows(
+                    find_api_key(entry.api_key), "input/batch", "send"
+                ):
+                    raise ValueError(
+                        "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"
+                    )
+
+            except ValueError as error:
+
+                results.append({"result": input_failure, "error": str(error)})
+                continue
+
+            deliveries.append(
+                asyncio.create_task(
+                    send_output(
+                        entry.json(exclude={"api_key"}),
+                        entry.subject,
+                        entry.message,
+                        entry.url,
+                        entry.priority,
+                        endpoint="input",
+                    )
+                )
+            )
+            results.append({"result": input_success})
+
+    except ValueError as error:
+
+        # Whatever arrived before the body went wrong has already been handed off,
+        # so it's still reported item by item.
+        await asyncio.gather(*deliveries)
+
+        if isinstance(error, BodyTooLarge):
+            response.status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+        return {"result": input_failure, "error": str(error), "items": results}
+
+    statuses = await asyncio.gather(*deliveries)
+
+    response.status_code = max(statuses, default=status.HTTP_200_OK)
+    return {"result": input_success, "items": results}
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+async def read_body(request):
+
+    # Bodies are read a chunk at a time, so one that's too large is turned away as soon
+    # as it passes max_body_size instead of being held in memory first.
+    length = request.headers.get("Content-Length", "")
+
+    if length.isdigit() and int(length) > max_body_size:
+        raise BodyTooLarge(
+            "Request body is larger than " + str(max_body_size) + " bytes"
+        )
+
+    received = 0
+
+    async for chunk in request.stream():
+
+        received += len(chunk)
+
+        if received > max_body_size:
+            raise BodyTooLarge(
+                "Request body is larger than " + str(max_body_size) + " bytes"
+            )
+
+        yield chunk
+
+
+async def read_ndjson(request):
+
+    buffer = b""
+
+    async for chunk in read_body(request):
+
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+
+        for line in lines:
+            if line.strip():
+                yield line
+
+    if buffer.strip():
+        yield buffer
+
+
+json_array_tokens = re.compile(rb'["\\\[\]{},]')
+
+
+async def read_json_array(request):
+
+    # The elements of the array are cut out as the body arrives, by following strings
+    # and nesting, and each one is only parsed on its own. The first element can be
+    # sent before the last one has been uploaded, and a malformed element only fails
+    # itself.
+    pending = bytearray()
+    scanned = 0
+    element_start = 0
+    depth = 0
+    in_string = False
+    escaped = -1
+    finished = False
+
+    async for chunk in read_body(request):
+
+        pending += chunk
+
+        for match in json_array_tokens.finditer(pending, scanned):
+
+            position = match.start()
+            token = match.group()
+
+            if finished:
+                break
+            elif position == escaped:
+                continue
+            elif in_string:
+                if token == b"\\":
+                    escaped = position + 1
+                elif token == b'"':
+                    in_string = False
+            elif token == b'"':
+                in_string = True
+            elif depth == 0:
+                if token != b"[" or pending[:position].strip():
+                    raise ValueError("Expected a JSON array")
+                depth = 1
+                element_start = position + 1
+            elif token in (b"[", b"{"):
+                depth += 1
+            elif token in (b"]", b"}"):
+                depth -= 1
+                if depth == 0:
+                    finished = True
+                    element = bytes(pending[element_start:position])
+                    if element.strip():
+                        yield element
+            elif depth == 1:
+                yield bytes(pending[element_start:position])
+                element_start = position + 1
+
+        if finished:
+            break
+
+        # Everything before the current element has been handled, so only the rest is
+        # kept for the next chunk.
+        del pending[:element_start]
+        scanned = len(pending)
+        escaped -= element_start
+        element_start = 0
+
+    if not finished:
+        raise ValueError("Expected a JSON array")
+
+
+@app.post(
+    "/healthchecks",
+    summary=desc_healthchecks,
+    description=desc_healthchecks,
+    tags=["Service Endpoints"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def healthchecks(payload: HealthChecksModel, response: Response):
+
+    try:
+        field_formatters["healthchecks"].render(payload)
+
+        response.status_code = await send_output(
+            payload.json(exclude={"api_key"}),
+            payload.subject,
+            payload.message,
+            payload.url,
+            payload.priority,
+            endpoint="healthchecks",
+        )
+        to_return = {"result": input_success}
+
+    except Exception:
+
+        to_return = {"result": input_failure}
+
+    return to_return
+
+
+@app.post(
+    "/monit",
+    summary=desc_monit,
+    description=desc_monit,
+    tags=["Service Endpoints"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def monit(payload: MonitModel, response: Response):
+
+    try:
+
+        field_formatters["monit"].render(payload)
+
+        response.status_code = await send_output(
+            payload.json(exclude={"api_key"}),
+            payload.subject,
+            payload.message,
+            payload.url,
+            payload.priority,
+            endpoint="monit",
+        )
+        to_return = {"result": input_success}
+
+    except Exception:
+
+        to_return = {"result": input_failure}
+
+    return to_return
+
+
+@app.post(
+    "/smokeping",
+    summary=desc_smokeping,
+    description=desc_smokeping,
+    tags=["Service Endpoints"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def smokeping(payload: SmokePingModel, response: Response):
+
+    try:
+        field_formatters["smokeping"].render(payload)
+
+        response.status_code = await send_output(
+            payload.json(exclude={"api_key"}),
+            payload.subject,
+            payload.message,
+            payload.url,
+            payload.priority,
+            endpoint="smokeping",
+        )
+        to_return = {"result": input_success}
+
+    except Exception:
+
+        to_return = {"result": input_failure}
+
+    return to_return
+
+
+@app.post(
+    "/uptimerobot",
+    summary=desc_uptimerobot,
+    description=desc_uptimerobot,
+    tags=["Service Endpoints"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def uptimerobot(payload: UptimeRobotModel, response: Response):
+
+    try:
+
+        field_formatters["uptimerobot"].render(payload)
+
+        response.status_code = await send_output(
+            payload.json(exclude={"api_key"}),
+            payload.subject,
+            payload.message,
+            payload.url,
+            payload.priority,
+            endpoint="uptimerobot",
+        )
+        to_return = {"result": input_success}
+
+    except Exception:
+
+        to_return = {"result": input_failure}
+
+    return to_return
+
+
+@app.post(
+    "/changedetectionio/{api_key}",
+    summary=desc_changedetectionio,
+    description=desc_changedetectionio,
+    tags=["Service Webhooks"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def webhook_changedetectionio(api_key: str, payload: Request, response: Response):
+
+    try:
+
+        result = json_loads(await payload.body())
+        response.status_code = await send_output(
+            result,
+            result["title"],
+            result["message"].removesuffix("\n---\n\n---"),
+            "",
+            0,
+            endpoint="changedetectionio",
+        )
+        return {"result": input_success}
+
+    except Exception:
+
+        return {"result": input_failure}
+
+
+@app.post(
+    "/headphones/{api_key}",
+    summary=desc_headphones,
+    description=desc_headphones,
+    tags=["Service Webhooks"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def webhook_headphones(api_key: str, payload: Request, response: Response):
+
+    try:
+
+        result = json_loads(await payload.body())
+        response.status_code = await send_output(
+            result, subject_headphones, result["text"], "", 0, endpoint="headphones"
+        )
+        return {"result": input_success}
+
+    except Exception:
+
+        return {"result": input_failure}
+
+
+@app.post(
+    "/homeassistant/{api_key}",
+    summary=desc_homeassistant,
+    description=desc_homeassistant,
+    tags=["Service Webhooks"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def webhook_homeassistant(api_key: str, payload: Request, response: Response):
+
+    try:
+
+        result = json_loads(await payload.body())
+        response.status_code = await send_output(
+            result,
+            subject_homeassistant,
+            result["text"],
+            "",
+            0,
+            endpoint="homeassistant",
+        )
+        return {"result": input_success}
+
+    except Exception:
+
+        return {"result": input_failure}
+
+
+@app.post(
+    "/lazylibrarian/{api_key}",
+    summary=desc_lazylibrarian,
+    description=desc_lazylibrarian,
+    tags=["Service Webhooks"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def webhook_lazylibrarian(api_key: str, payload: Request, response: Response):
+
+    try:
+
+        result = json_loads(await payload.body())
+        response.status_code = await send_output(
+            result,
+            subject_lazylibrarian,
+            result["text"],
+            "",
+            0,
+            endpoint="lazylibrarian",
+        )
+        return {"result": input_success}
+
+    except Exception:
+
+        return {"result": input_failure}
+
+
+@app.post(
+    "/radarr/{api_key}",
+    summary=desc_radarr,
+    description=desc_radarr,
+    tags=["Service Webhooks"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def webhook_radarr(api_key: str, payload: Request, response: Response):
+
+    try:
+
+        result = json_loads(await payload.body())
+        full_message = (
+            str(result["movie"]["title"]) + " [" + str(result["movie"]["year"]) + "]"
+        )
+        response.status_code = await send_output(
+            result, subject_radarr, full_message, "", 0, endpoint="radarr"
+        )
+        return {"result": input_success}
+
+    except Exception:
+
+        return {"result": input_failure}
+
+
+@app.post(
+    "/sonarr/{api_key}",
+    summary=desc_sonarr,
+    description=desc_sonarr,
+    tags=["Service Webhooks"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def webhook_sonarr(api_key: str, payload: Request, response: Response):
+
+    try:
+
+        result = json_loads(await payload.body())
+
+        subject_end = ""
+        match result["eventType"]:
+            case "Backup":
+                subject_end = " -- Episode Backed Up"
+            case "Corrupt":
+                subject_end = " -- Episode Corrupted"
+            case "Deleted":
+                subject_end = " -- Episode Deleted"
+            case "Download":
+                subject_end = " -- Episode Downloaded"
+            case "Event":
+                subject_end = " -- Event"
+            case "Failed":
+                subject_end = " -- Corrupted"
+            case "Grab":
+                subject_end = " -- Grabbed"
+            case "Health":
+                subject_end = " -- Health Issues"
+            case "Test":
+                subject_end = " -- Test"
+            case "Update":
+                subject_end = " -- Updated"
+            case "Upgrade":
+                subject_end = " -- Upgraded"
+        full_subject = subject_sonarr + subject_end
+
+        # The Sonarr test notification doesn't include an air date, in which case a default value needs to be set
+        try:
+
+            air_date = result["episodes"][0]["airDate"]
+
+        except:
+
+            air_date = "unknown air date"
+
+        full_message = (
+            str(result["eventType"])
+            + "\n\n"
+            + str(result["series"]["title"])
+            + " - "
+            + str(result["episodes"][0]["seasonNumber"])
+            + "x"
+            + str(result["episodes"][0]["episodeNumber"])
+            + " - "
+            + str(result["episodes"][0]["title"])
+            + " ["
+            + str(air_date)
+            + "]"
+        )
+
+        response.status_code = await send_output(
+            result, full_subject, full_message, "", 0, endpoint="sonarr"
+        )
+        return {"result": input_success}
+
+    except Exception:
+
+        return {"result": input_failure}
+
+
+@app.post(
+    "/synology/{api_key}",
+    summary=desc_synology,
+    description=desc_synology,
+    tags=["Service Webhooks"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def webhook_synology(api_key: str, payload: Request, response: Response):
+
+    try:
+
+        result = json_loads(await payload.body())
+        response.status_code = await send_output(
+            result, subject_synology, result["message"], "", 0, endpoint="synology"
+        )
+        return {"result": input_success}
+
+    except Exception:
+
+        return {"result": input_failure}
+
+
+@app.post(
+    "/tailscale/{api_key}",
+    summary=desc_tailscale,
+    description=desc_tailscale,
+    tags=["Service Webhooks"],
+    status_code=status.HTTP_200_OK,
+    include_in_schema=True,
+)
+async def webhook_tailscale(api_key: str, payload: Request, response: Response):
+
+    results = []
+    deliveries = []
+
+    try:
+
+        # Events are handed off one by one while the rest of the array is still
+        # arriving, and a malformed event is reported without failing the others.
+        async for item in read_json_array(payload):
+
+            try:
+
+                event = json_loads(item)
+
+                full_message = (
+                    "Type: " + str(event["type"]) + "\n" + str(event["message"])
+                )
+
+                if event["data"] not in (None, ""):
+                    full_message = full_message + ("\n\nData: " + str(event["data"]))
+
+                subject = subject_tailscale + " (" + event["tailnet"] + ")"
+
+            except (ValueError, TypeError, KeyError) as error:
+
+                results.append({"result": input_failure, "error": repr(error)})
+                continue
+
+            deliveries.append(
+                asyncio.create_task(
+                    send_output(
+                        event, subject, full_message, "", 0, endpoint="tailscale"
+                    )
+                )
+            )
+            results.append({"result": input_success})
+
+    except ValueError as error:
+
+        await asyncio.gather(*deliveries)
+
+        if isinstance(error, BodyTooLarge):
+            response.status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+        return {"result": input_failure, "error": str(error), "events": results}
+
+    statuses = await asyncio.gather(*deliveries)
+
+    response.status_code = max(statuses, default=status.HTTP_200_OK)
+    return {"result": input_success, "events": results}
+
+
+class OutputError(Exception):
+    def __init__(self, error):
+        super().__init__(error)
+        self.retryable = is_retryable(error)
+        self.response = getattr(error, "response", None)
+
+    @property
+    def rate_limited(self):
+        return self.response is not None and self.response.status_code == 429
+
+
+def is_retryable(error):
+
+    # Server errors, rate limiting, timeouts and dropped connections are worth another
+    # try, anything else (such as a bad token or a malformed request) will fail again.
+    if requests is not None and isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and (
+            error.response.status_code >= 500
+            or error.response.status_code in (408, 429)
+        )
+
+    if smtplib is not None and isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+
+    transient_errors = (ConnectionError, TimeoutError)
+
+    if requests is not None:
+        transient_errors += (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        )
+
+    if smtplib is not None:
+        transient_errors += (smtplib.SMTPServerDisconnected,)
+
+    return isinstance(error, transient_errors)
+
+
+class Notification:
+    __slots__ = (
+        "request_body",
+        "subject",
+        "message",
+        "url",
+        "priority",
+        "endpoint",
+        "id",
+        "created",
+        "cache",
+    )
+
+    def __init__(
+        self,
+        request_body,
+        subject,
+        message,
+        url,
+        priority,
+        endpoint=None,
+        id=None,
+        created=None,
+    ):
+        set_field = super().__setattr__
+        set_field("request_body", request_body)
+        set_field("subject", subject)
+        set_field("message", message)
+        set_field("url", url)
+        set_field("priority", priority)
+        set_field("endpoint", endpoint)
+        set_field("id", id or uuid.uuid4().hex)
+        set_field("created", created or time.time())
+        set_field("cache", {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Notifications can't be changed once created")
+
+    def to_json(self):
+        return json_dumps(
+            {
+                "request_body": self.request_body,
+                "subject": self.subject,
+                "message": self.message,
+                "url": self.url,
+                "priority": self.priority,
+                "endpoint": self.endpoint,
+                "id": self.id,
+                "created": self.created,
+            }
+        ).decode()
+
+    def fields(self):
+
+        if "fields" not in self.cache:
+
+            # The service endpoints pass their payload along as a JSON string, the
+            # webhooks pass the parsed body.
+            if isinstance(self.request_body, str):
+                try:
+                    body = json_loads(self.request_body)
+                except ValueError:
+                    body = None
+            else:
+                body = self.request_body
+
+            self.cache["fields"] = body if isinstance(body, dict) else {}
+
+        return self.cache["fields"]
+
+    def encode(self, value, *key):
+
+        # Outbound JSON bodies are encoded once per notification, keyed by whatever
+        # makes them differ between accounts, and reused for every account and retry.
+        key = ("json",) + key
+
+        if key not in self.cache:
+            self.cache[key] = json_dumps(value)
+
+        return self.cache[key]
+
+    def render(self, style, *args):
+
+        # Each style is only built the first time an output asks for it, every other
+        # account (and every retry) reuses the same string.
+        key = (style,) + args
+
+        if key not in self.cache:
+            self.cache[key] = build_message(style, self, *args)
+
+        return self.cache[key]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**json_loads(data))
+
+
+output_semaphore = asyncio.Semaphore(max_concurrent_outputs)
+
+# Senders block, so they run on threads of their own. First sends and retries are
+# each capped at max_concurrent_outputs, which is as many as can ever be running, so a
+# slow provider can't use up threads that other providers are waiting for.
+output_executor = concurrent.futures.ThreadPoolExecutor(
+    2 * max_concurrent_outputs, thread_name_prefix="homelabapi-output"
+)
+
+
+# The libraries for talking to providers are only imported once an output that needs
+# them is configured, which keeps them out of startup when they aren't used. requests
+# alone takes longer to import than the rest of HomelabAPI's own module.
+requests = None
+smtplib = None
+
+
+def import_output_modules(output):
+
+    global email, requests, smtplib, TimeoutHTTPAdapter
+
+    if output == "email":
+
+        if smtplib is None:
+            import email.message
+            import smtplib
+
+    elif requests is None:
+
+        import requests
+
+        class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+            def send(self, request, timeout=None, **kwargs):
+                return super().send(
+                    request, timeout=timeout or output_timeout, **kwargs
+                )
+
+
+def create_http_session():
+
+    # The pool is sized so that every concurrent send to a provider can hold its own
+    # kept-alive connection. Every request gets a timeout, so a provider that has gone
+    # away can't hold a send (and its worker thread) forever.
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=4, pool_maxsize=max_concurrent_outputs
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+# Settings that every account of an output needs, checked before a configuration is used.
+required_account_settings = {
+    "discord": ("url", "username"),
+    "email": ("server", "protocol", "port", "email_sender", "email_receiver"),
+    "gotify": ("url", "token"),
+    "matrix": ("url", "room", "token"),
+    "ntfysh": ("topic",),
+    "pushbullet": ("api_key",),
+    "pushover": ("api_token", "api_user"),
+    "telegram": ("api_key", "user_id"),
+    "webhook": ("url",),
+}
+
+Destination = collections.namedtuple("Destination", ("output", "account", "client"))
+
+DispatchTable = collections.namedtuple(
+    "DispatchTable",
+    ("api_keys", "destinations", "routes", "catch_all_routes", "clients", "templates"),
+)
+
+Route = collections.namedtuple("Route", ("predicates", "destinations"))
+
+
+def match_source(source, notification):
+    return str(notification.fields().get("source")) == source
+
+
+def match_min_priority(level, notification):
+    return priority_level(notification.priority) >= level
+
+
+def match_max_priority(level, notification):
+    return priority_level(notification.priority) <= level
+
+
+def match_subject(pattern, notification):
+    return pattern.search(notification.subject or "") is not None
+
+
+def match_fields(patterns, notification):
+
+    fields = notification.fields()
+
+    return all(
+        name in fields and pattern.search(str(fields[name])) is not None
+        for name, pattern in patterns.items()
+    )
+
+
+def compile_pattern(pattern):
+
+    try:
+        return re.compile(str(pattern))
+    except re.error as error:
+        raise ValueError("Invalid route pattern " + repr(pattern) + ": " + str(error))
+
+
+def compile_predicates(rule):
+
+    predicates = []
+
+    for key, value in rule.items():
+        match key:
+            case "endpoint" | "outputs":
+                pass
+            case "source":
+                predicates.append(functools.partial(match_source, str(value)))
+            case "min_priority":
+                predicates.append(functools.partial(match_min_priority, int(value)))
+            case "max_priority":
+                predicates.append(functools.partial(match_max_priority, int(value)))
+            case "subject":
+                predicates.append(
+                    functools.partial(match_subject, compile_pattern(value))
+                )
+            case "fields":
+                predicates.append(
+                    functools.partial(
+                        match_fields,
+                        {
+                            str(name): compile_pattern(pattern)
+                            for name, pattern in value.items()
+                        },
+                    )
+                )
+            case _:
+                raise ValueError("Unknown route setting: " + key)
+
+    return tuple(predicates)
+
+
+def parse_route_endpoints(value):
+
+    if value is None:
+        return ()
+    elif isinstance(value, str):
+        return tuple(endpoint.strip() for endpoint in value.split(","))
+    else:
+        return tuple(value)
+
+
+def build_dispatch_table(configuration, previous=None):
+
+    app_settings = configuration["application"]
+    api_keys = parse_api_keys(app_settings)
+    configured_outputs = parse_outputs(configuration["outputs"])
+    templates = app_settings.get("message_templates") or {}
+    rules = configuration.get("routes") or []
+
+    # One long-lived client per output provider (per login for email), shared by all of
+    # its accounts. Clients from the previous table are carried over, so a reload
+    # doesn't throw away open connections to providers that haven't changed.
+    previous_clients = previous.clients if previous is not None else {}
+    clients = {}
+    output_destinations = {}
+
+    def destinations_for(outputs, setting):
+
+        destinations = []
+
+        for output in outputs:
+
+            if output not in all_outputs:
+                raise ValueError("Unknown output in " + setting + ": " + output)
+
+            if output not in output_destinations:
+                output_destinations[output] = []
+
+                for account in configured_outputs.get(output) or []:
+
+                    for setting_name in required_account_settings[output]:
+                        if setting_name not in account:
+                            raise ValueError(
+                                output + " account is missing " + setting_name
+                            )
+
+                    import_output_modules(output)
+
+                    if output == "email":
+                        key = smtp_key(account)
+                        create_client = functools.partial(SMTPSession, account)
+                    else:
+                        key = output
+                        create_client = create_http_session
+
+                    if key not in clients:
+                        clients[key] = previous_clients.get(key) or create_client()
+
+                    output_destinations[output].append(
+                        Destination(output, account, clients[key])
+                    )
+
+            # An output without accounts would quietly drop everything sent to it,
+            # routes that should send nowhere say so with an empty list.
+            if not output_destinations[output]:
+                raise ValueError(
+                    output + " is used in " + setting + " but has no accounts"
+                )
+
+            destinations.extend(output_destinations[output])
+
+        return tuple(destinations)
+
+    def parse_selected_outputs(value):
+
+        # "all" is every output that has accounts in config.yaml.
+        if value == "all":
+            return [output for output in all_outputs if configured_outputs.get(output)]
+
+        return parse_current_outputs(value)
+
+    destinations = destinations_for(
+        parse_selected_outputs(app_settings["current_outputs"]), "current_outputs"
+    )
+
+    # Routes are indexed by input endpoint, each endpoint keeping its own rules and the
+    # rules without an endpoint in config.yaml order. Finding the rules to check for a
+    # notification is then a single lookup, however many routes there are.
+    compiled_routes = []
+
+    for rule in rules:
+
+        if "outputs" not in rule:
+            raise ValueError("Every route needs outputs")
+
+        outputs = rule["outputs"]
+
+        if isinstance(outputs, str):
+            outputs = parse_selected_outputs(outputs)
+
+        compiled_routes.append(
+            (
+                parse_route_endpoints(rule.get("endpoint")),
+                Route(compile_predicates(rule), destinations_for(outputs, "routes")),
+            )
+        )
+
+    routes = {}
+
+    for endpoints, route in compiled_routes:
+        for endpoint in endpoints:
+            routes[endpoint] = tuple(
+                other_route
+                for other_endpoints, other_route in compiled_routes
+                if endpoint in other_endpoints or not other_endpoints
+            )
+
+    return DispatchTable(
+        api_keys,
+        destinations,
+        routes,
+        tuple(route for endpoints, route in compiled_routes if not endpoints),
+        clients,
+        {
+            output: template_environment.from_string(template)
+            for output, template in templates.items()
+        },
+    )
+
+
+def configured_destinations(table):
+
+    destinations = {}
+
+    for destination in table.destinations + tuple(
+        destination
+        for routes in (table.catch_all_routes, *table.routes.values())
+        for route in routes
+        for destination in route.destinations
+    ):
+        destinations.setdefault(id(destination.account), destination)
+
+    return destinations.values()
+
+
+def route_notification(table, notification):
+
+    # The first route whose conditions all match decides the destinations. Without a
+    # matching route, the notification goes to every account of current_outputs.
+    for route in table.routes.get(notification.endpoint, table.catch_all_routes):
+        if all(predicate(notification) for predicate in route.predicates):
+            return route.destinations
+
+    return table.destinations
+
+
+def open_database(path):
+
+    connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+    return connection
+
+
+class Outbox:
+    def __init__(self, path):
+        self.connection = open_database(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "created REAL NOT NULL, "
+            "notification TEXT NOT NULL)"
+        )
+        self.ready = asyncio.Event()
+        self.version = None
+        self.leading = False
+        self.lock_file = open(path + ".lock", mode="ab")
+
+    def put(self, notification):
+        self.connection.execute(
+            "INSERT INTO outbox (created, notification) VALUES (?, ?)",
+            (time.time(), notification.to_json()),
+        )
+        self.ready.set()
+
+    def take(self, after_id, limit):
+        self.version = self.data_version()
+        rows = self.connection.execute(
+            "SELECT id, notification FROM outbox WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        )
+        return [(row[0], Notification.from_json(row[1])) for row in rows]
+
+    def remove(self, entry_id):
+        self.connection.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def size(self):
+        return self.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def data_version(self):
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    async def wait(self):
+
+        # Entries put by this process set the event. Entries put by other worker
+        # processes change the data version instead, which is cheap enough to poll.
+        while self.data_version() == self.version:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.ready.wait(), timeout=outbox_poll_interval)
+                return
+
+    def lead(self):
+
+        # Only the process holding the lock delivers, so dedup windows, digests, rate
+        # limits and circuit breakers all live in one place however many workers
+        # uvicorn runs. The lock goes away with its process, letting another take over.
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.leading = True
+            return True
+        except BlockingIOError:
+            return False
+
+    def close(self):
+        self.connection.close()
+        self.lock_file.close()
+
+
+class DeadLetters:
+    def __init__(self, path):
+        self.connection = open_database(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letters ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "created REAL NOT NULL, "
+            "output TEXT NOT NULL, "
+            "account TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL, "
+            "error TEXT NOT NULL, "
+            "notification TEXT NOT NULL)"
+        )
+
+    def put(self, output, account, notification, attempts, error):
+        self.connection.execute(
+            "INSERT INTO dead_letters "
+            "(created, output, account, attempts, error, notification) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                time.time(),
+                output,
+                account.get("name", output),
+                attempts,
+                str(error),
+                notification.to_json(),
+            ),
+        )
+
+    def page(self, after_id, since, until, output, limit):
+
+        conditions = ["id > ?"]
+        parameters = [after_id]
+
+        for condition, value in (
+            ("created >= ?", since),
+            ("created < ?", until),
+            ("output = ?", output),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        return self.connection.execute(
+            "SELECT id, notification FROM dead_letters WHERE "
+            + " AND ".join(conditions)
+            + " ORDER BY id LIMIT ?",
+            parameters + [limit],
+        ).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+# Every notification that's dispatched, and every attempt to send it, is appended to
+# numbered segment files of JSON lines. The files are only ever appended to, and whole
+# segments are deleted once the journal is over its size or age budget. The database
+# holds an index pointing into the segments, for querying by time, endpoint or source.
+class Journal:
+    def __init__(self, directory, path):
+        self.directory = directory
+        self.connection = open_database(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS journal_entries ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "id TEXT NOT NULL UNIQUE, "
+            "created REAL NOT NULL, "
+            "endpoint TEXT, "
+            "source TEXT, "
+            "status TEXT NOT NULL, "
+            "segment INTEGER NOT NULL, "
+            "offset INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS journal_attempts ("
+            "id TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "output TEXT NOT NULL, "
+            "account TEXT NOT NULL, "
+            "attempt INTEGER NOT NULL, "
+            "result TEXT NOT NULL, "
+            "duration REAL NOT NULL, "
+            "error TEXT, "
+            "segment INTEGER NOT NULL)"
+        )
+        for columns in ("created", "endpoint, created", "source, created"):
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS journal_entries_"
+                + columns.replace(", ", "_")
+                + " ON journal_entries ("
+                + columns
+                + ")"
+            )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS journal_attempts_id ON journal_attempts (id)"
+        )
+        os.makedirs(directory, exist_ok=True)
+        self.file = None
+        self.segment = None
+        self.started = None
+
+    def segments(self):
+        return sorted(
+            int(name.removesuffix(".jsonl"))
+            for name in os.listdir(self.directory)
+            if name.endswith(".jsonl") and name.removesuffix(".jsonl").isdigit()
+        )
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, "%08d.jsonl" % segment)
+
+    def append(self, record):
+
+        # Segments are opened lazily, so worker processes that never dispatch don't
+        # touch the files.
+        if (
+            self.file is None
+            or self.file.tell() >= journal_segment_size
+            or time.time() - self.started >= journal_segment_age
+        ):
+            self.rotate()
+
+        offset = self.file.tell()
+        self.file.write(json_dumps(record) + b"\n")
+        self.file.flush()
+
+        return offset
+
+    def rotate(self):
+
+        if self.file is not None:
+            self.file.close()
+            self.segment += 1
+        else:
+            self.segment = max(self.segments(), default=0) or 1
+
+        self.file = open(self.segment_path(self.segment), mode="ab")
+        self.started = self.first_created(self.segment) or time.time()
+        self.prune()
+
+    def first_created(self, segment):
+
+        # A segment's age counts from its first record, so a segment that's carried on
+        # with after a restart isn't treated as new.
+        with open(self.segment_path(segment), mode="rb") as file:
+            line = file.readline()
+
+        with contextlib.suppress(ValueError, KeyError, TypeError):
+            return json_loads(line)["created"]
+
+    def maintain(self):
+
+        # Only the process that writes the segments prunes them. A quiet journal still
+        # moves on to a new segment once the current one is too old, as the segment
+        # being written to is never pruned.
+        if self.file is None:
+            return
+
+        if self.file.tell() > 0 and time.time() - self.started >= journal_segment_age:
+            self.rotate()
+        else:
+            self.prune()
+
+    def prune(self):
+
+        segments = self.segments()
+        sizes = {
+            segment: os.path.getsize(self.segment_path(segment)) for segment in segments
+        }
+        total = sum(sizes.values())
+
+        for segment in segments[:-1]:
+
+            path = self.segment_path(segment)
+
+            if total <= journal_max_size and os.path.getmtime(path) > (
+                time.time() - journal_max_age
+            ):
+                break
+
+            os.remove(path)
+            total -= sizes[segment]
+            self.connection.execute(
+                "DELETE FROM journal_entries WHERE segment = ?", (segment,)
+            )
+            self.connection.execute(
+                "DELETE FROM journal_attempts WHERE segment = ?", (segment,)
+            )
+
+    def record(self, notification):
+
+        if "journaled" in notification.cache:
+            return
+
+        notification.cache["journaled"] = True
+        source = notification.fields().get("source")
+
+        offset = self.append(
+            {
+                "type": "notification",
+                "id": notification.id,
+                "created": notification.created,
+                "endpoint": notification.endpoint,
+                "source": source,
+                "subject": notification.subject,
+                "message": notification.message,
+                "url": notification.url,
+                "priority": notification.priority,
+                "body": notification.request_body,
+            }
+        )
+        self.connection.execute(
+            "INSERT OR IGNORE INTO journal_entries "
+            "(id, created, endpoint, source, status, segment, offset) "
+            "VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+            (
+                notification.id,
+                notification.created,
+                notification.endpoint,
+                None if source is None else str(source),
+                self.segment,
+                offset,
+            ),
+        )
+
+    def mark(self, notification, status):
+
+        self.append({"type": status, "id": notification.id, "created": time.time()})
+        self.connection.execute(
+            "UPDATE journal_entries SET status = ? WHERE id = ?",
+            (status, notification.id),
+        )
+
+    def record_attempt(
+        self, destination, notification, attempt, result, duration, error
+    ):
+
+        account = destination.account.get("name", destination.output)
+        created = time.time()
+        error = None if error is None else str(error)
+
+        self.append(
+            {
+                "type": "attempt",
+                "id": notification.id,
+                "created": created,
+                "output": destination.output,
+                "account": account,
+                "attempt": attempt,
+                "result": result,
+                "duration": duration,
+                "error": error,
+            }
+        )
+        self.connection.execute(
+            "INSERT INTO journal_attempts (id, created, output, account, attempt, "
+            "result, duration, error, segment) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                notification.id,
+                created,
+                destination.output,
+                account,
+                attempt,
+                result,
+                duration,
+                error,
+                self.segment,
+            ),
+        )
+
+        # An output that gave up marks the whole notification as failed, which sticks
+        # even if other outputs got it.
+        if result in ("delivered", "failed"):
+            self.connection.execute(
+                "UPDATE journal_entries SET status = ? WHERE id = ? AND status != 'failed'",
+                (result, notification.id),
+            )
+
+    def query(
+        self,
+        since=None,
+        until=None,
+        endpoint=None,
+        source=None,
+        status=None,
+        before=None,
+        after=None,
+        limit=50,
+    ):
+
+        conditions = []
+        parameters = []
+
+        for condition, value in (
+            ("created >= ?", since),
+            ("created < ?", until),
+            ("endpoint = ?", endpoint),
+            ("source = ?", source),
+            ("status = ?", status),
+            ("seq < ?", before),
+            ("seq > ?", after),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        return self.connection.execute(
+            "SELECT seq, id, status, segment, offset FROM journal_entries"
+            + (" WHERE " + " AND ".join(conditions) if conditions else "")
+            + (" ORDER BY seq DESC" if after is None else " ORDER BY seq")
+            + " LIMIT ?",
+            parameters + [limit],
+        ).fetchall()
+
+    def read(self, segment, offset):
+
+        with open(self.segment_path(segment), mode="rb") as file:
+            file.seek(offset)
+            return json_loads(file.readline())
+
+    def notification(self, segment, offset):
+
+        record = self.read(segment, offset)
+        notification = Notification(
+            record["body"],
+            record["subject"],
+            record["message"],
+            record["url"],
+            record["priority"],
+            record["endpoint"],
+            record["id"],
+            record["created"],
+        )
+        notification.cache["journaled"] = True
+
+        return notification
+
+    def replayed(self, notification):
+
+        # Only the index is updated, as the process replaying may not be the one that
+        # writes to the segments.
+        self.connection.execute(
+            "UPDATE journal_entries SET status = 'replayed' WHERE id = ?",
+            (notification.id,),
+        )
+
+    def attempts(self, ids):
+
+        attempts = collections.defaultdict(list)
+        rows = self.connection.execute(
+            "SELECT id, created, output, account, attempt, result, duration, error "
+            "FROM journal_attempts WHERE id IN ("
+            + ", ".join("?" * len(ids))
+            + ") ORDER BY rowid",
+            ids,
+        )
+
+        for id, created, output, account, attempt, result, duration, error in rows:
+            attempts[id].append(
+                {
+                    "created": created,
+                    "output": output,
+                    "account": account,
+                    "attempt": attempt,
+                    "result": result,
+                    "duration": duration,
+                    "error": error,
+                }
+            )
+
+        return attempts
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.connection.close()
+
+
+outbox = Outbox(database_path) if outbox_enabled else None
+outbox_worker = None
+dead_letters = DeadLetters(database_path)
+journal = Journal(journal_path, database_path) if journal_enabled else None
+
+# Retries get their own slots, so a provider that keeps failing can't hold up fresh
+# notifications while its retries wait their turn.
+retry_semaphore = asyncio.Semaphore(max_concurrent_outputs)
+background_tasks = set()
+
+
+def start_background_task(coroutine):
+
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    return task
+
+
+async def maintain_journal():
+
+    while True:
+        await asyncio.sleep(60)
+        journal.maintain()
+
+
+class DedupWindow:
+    __slots__ = ("notification", "repeats", "timer")
+
+    def __init__(self, notification, timer):
+        self.notification = notification
+        self.repeats = 0
+        self.timer = timer
+
+
+class Deduplicator:
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        self.windows = collections.OrderedDict()
+
+    def fingerprint(self, notification):
+
+        fields = dedup_fingerprints.get(notification.endpoint, ["subject", "message"])
+        body = notification.fields()
+
+        return (notification.endpoint,) + tuple(
+            str(body.get(field, getattr(notification, field, None))) for field in fields
+        )
+
+    def admit(self, notification):
+
+        key = self.fingerprint(notification)
+        window = self.windows.get(key)
+
+        if window is not None:
+            window.repeats += 1
+            window.notification = notification
+            self.windows.move_to_end(key)
+            return False
+
+        timer = asyncio.get_running_loop().call_later(self.window, self.close, key)
+        self.windows[key] = DedupWindow(notification, timer)
+
+        # The least recently repeated window is closed early once the index is full,
+        # which keeps memory bounded no matter how many monitors are flapping.
+        if len(self.windows) > self.max_entries:
+            self.close(next(iter(self.windows)))
+
+        return True
+
+    def close(self, key):
+
+        window = self.windows.pop(key)
+        window.timer.cancel()
+
+        if window.repeats:
+            notification = window.notification
+            summary = Notification(
+                notification.request_body,
+                notification.subject,
+                notification.message.rstrip("\n")
+                + "\n\n("
+                + str(window.repeats)
+                + " repeats suppressed)",
+                notification.url,
+                notification.priority,
+                notification.endpoint,
+            )
+            start_background_task(deliver_notification(summary))
+
+
+deduplicator = Deduplicator(dedup_window, dedup_max_entries) if dedup_window else None
+
+
+def priority_level(priority):
+
+    try:
+        return int(priority)
+    except (TypeError, ValueError):
+        return 0
+
+
+class Digest:
+    __slots__ = ("notifications", "started", "timer")
+
+    def __init__(self):
+        self.notifications = []
+        self.started = time.monotonic()
+        self.timer = None
+
+
+class Coalescer:
+    def __init__(self, windows, max_batch, max_delay, bypass_priority):
+        self.windows = windows
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.bypass_priority = bypass_priority
+        self.digests = {}
+
+    def hold(self, notification):
+
+        if priority_level(notification.priority) >= self.bypass_priority:
+            return False
+
+        # A window can be set for an input endpoint or for a "source" value.
+        key = notification.endpoint
+        window = self.windows.get(key)
+
+        if window is None:
+            key = notification.fields().get("source")
+            window = self.windows.get(key)
+
+        if window is None:
+            return False
+
+        digest = self.digests.get(key)
+
+        if digest is None:
+            digest = self.digests[key] = Digest()
+        else:
+            digest.timer.cancel()
+
+        digest.notifications.append(notification)
+
+        if len(digest.notifications) >= self.max_batch:
+            self.flush(key)
+            return True
+
+        # Every new notification restarts the window, but the digest never waits longer
+        # than max_delay after its first notification.
+        delay = min(window, digest.started + self.max_delay - time.monotonic())
+        digest.timer = asyncio.get_running_loop().call_later(
+            max(0, delay), self.flush, key
+        )
+
+        return True
+
+    def size(self):
+        return sum(len(digest.notifications) for digest in self.digests.values())
+
+    def flush(self, key):
+
+        digest = self.digests.pop(key)
+        if digest.timer is not None:
+            digest.timer.cancel()
+
+        return start_background_task(deliver_digest(digest.notifications))
+
+
+async def deliver_digest(notifications):
+
+    await deliver_notification(merge(notifications))
+
+    # Held notifications stay in the outbox until their digest has been sent, so a
+    # restart in the meantime sends them again rather than losing them.
+    for notification in notifications:
+        if "outbox_entry" in notification.cache:
+            outbox.remove(notification.cache["outbox_entry"])
+
+
+def merge(notifications):
+
+    if len(notifications) == 1:
+        return notifications[0]
+
+    first = notifications[0]
+
+    entries = [
+        (
+            notification.message
+            if notification.subject == first.subject
+            else notification.subject + "\n" + notification.message
+        )
+        for notification in notifications
+    ]
+
+    urls = {notification.url for notification in notifications}
+
+    return Notification(
+        [notification.request_body for notification in notifications],
+        first.subject + " (" + str(len(notifications)) + " notifications)",
+        "\n\n".join(entries),
+        urls.pop() if len(urls) == 1 else "",
+        max(
+            (notification.priority for notification in notifications),
+            key=priority_level,
+        ),
+        first.endpoint,
+    )
+
+
+coalescer = (
+    Coalescer(
+        digest_windows, digest_max_batch, digest_max_delay, digest_bypass_priority
+    )
+    if digest_windows
+    else None
+)
+
+
+async def deliver_outbox():
+
+    while not outbox.lead():
+        await asyncio.sleep(5)
+
+    logger.info("Delivering notifications from the outbox in process %s", os.getpid())
+
+    deliveries = set()
+    last_id = 0
+
+    while True:
+
+        if len(deliveries) >= max_concurrent_outputs:
+            await asyncio.wait(deliveries, return_when=asyncio.FIRST_COMPLETED)
+            continue
+
+        outbox.ready.clear()
+        entries = outbox.take(last_id, max_concurrent_outputs - len(deliveries))
+
+        for entry_id, notification in entries:
+            last_id = entry_id
+            delivery = asyncio.create_task(deliver_outbox_entry(entry_id, notification))
+            deliveries.add(delivery)
+            delivery.add_done_callback(deliveries.discard)
+
+        if not entries:
+            await outbox.wait()
+
+
+async def deliver_outbox_entry(entry_id, notification):
+
+    notification.cache["outbox_entry"] = entry_id
+    await dispatch_notification(notification)
+
+    # Entries are only removed once every output has been tried, so anything that was
+    # in flight when the container stopped is sent again on the next start. Entries
+    # held for a digest are removed when the digest goes out.
+    if "held" not in notification.cache:
+        outbox.remove(entry_id)
+
+
+@app.on_event("startup")
+def start_asset_compression():
+    threading.Thread(target=compress_assets, daemon=True).start()
+
+
+@app.on_event("startup")
+def start_outbox():
+
+    global outbox_worker
+
+    if outbox is not None:
+        outbox_worker = asyncio.get_running_loop().create_task(deliver_outbox())
+
+
+@app.on_event("startup")
+def start_journal_maintenance():
+
+    # Segments get too old without anything being written, so pruning can't wait for
+    # the next rotation.
+    if journal is not None:
+        start_background_task(maintain_journal())
+
+
+# Default pacing per account as (sends per second, burst size), based on the limits
+# that each provider publishes. Accounts can override these with the "rate_limit" and
+# "rate_limit_burst" settings.
+default_rate_limits = {
+    "discord": (2.5, 5),
+    "email": (1, 10),
+    "gotify": (10, 20),
+    "matrix": (0.2, 10),
+    "ntfysh": (0.2, 60),
+    "pushbullet": (1, 5),
+    "pushover": (2, 2),
+    "telegram": (1, 3),
+    "webhook": (10, 20),
+}
+
+
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.configured_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+
+        # Waiting on the lock queues senders in arrival order while the bucket refills.
+        async with self.lock:
+            while True:
+
+                now = time.monotonic()
+
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def observe(self, response):
+
+        if response is None:
+            return
+
+        if response.status_code == 429:
+            # Slow down until the provider stops complaining, then creep back up.
+            self.rate = max(self.rate / 2, self.configured_rate / 16)
+            self.pause(retry_after(response))
+        else:
+            self.rate = min(self.configured_rate, self.rate * 1.1)
+
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                self.pause(rate_limit_reset(response))
+
+    def pause(self, seconds):
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
 
-    if api_key == app_api_key:
+def retry_after(response):
 
+    value = response.headers.get("Retry-After")
+
+    if value is None:
+        # Discord and Telegram also say how long to wait in the response body.
         try:
+            body = response.json()
+            value = body.get("retry_after") or body["parameters"]["retry_after"]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return rate_limit_reset(response)
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(
+            0, email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        )
+    except (TypeError, ValueError):
+        return 1
 
-            result = await payload.json()
-            send_output(result, subject_headphones, result["text"], "", 0)
-            return {"result": input_success}
 
-        except Exception:
+def rate_limit_reset(response):
 
-            return {"result": input_failure}
+    value = response.headers.get("X-RateLimit-Reset-After") or response.headers.get(
+        "X-RateLimit-Reset"
+    )
 
-    else:
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return 1
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+    # Some providers send the reset time as a Unix timestamp instead of a delay.
+    if seconds > 1000000000:
+        seconds -= time.time()
 
+    return max(0, seconds)
 
-@app.post(
-    "/homeassistant/{api_key}",
-    summary=desc_homeassistant,
-    description=desc_homeassistant,
-    tags=["Service Webhooks"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def webhook_homeassistant(api_key: str, payload: Request):
 
-    if api_key == app_api_key:
+rate_limiters = {}
 
-        try:
 
-            result = await payload.json()
-            send_output(result, subject_homeassistant, result["text"], "", 0)
-            return {"result": input_success}
+def get_rate_limiter(output, account):
 
-        except Exception:
+    key = (output, json.dumps(account, sort_keys=True))
 
-            return {"result": input_failure}
+    if key not in rate_limiters:
+        rate, burst = default_rate_limits[output]
+        rate_limiters[key] = RateLimiter(
+            float(account.get("rate_limit", rate)),
+            float(account.get("rate_limit_burst", burst)),
+        )
 
-    else:
+    return rate_limiters[key]
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.state = "closed"
+        self.results = collections.deque(maxlen=circuit_window)
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.last_error = None
+        self.last_error_at = None
+
+    def allow(self):
+
+        if (
+            self.state == "open"
+            and time.monotonic() >= self.opened_at + circuit_open_time
+        ):
+            self.state = "half_open"
+
+        # A half-open circuit lets a single probe through, its result decides whether
+        # the circuit closes again or stays open for another circuit_open_time.
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+
+        return self.state == "closed"
+
+    def record(self, error):
+
+        self.probing = False
+
+        # Only errors that point at the provider being down count as failures. A
+        # response of any other kind (even a 4xx or a 429) shows that it's reachable.
+        if (
+            isinstance(error, OutputError)
+            and error.retryable
+            and not error.rate_limited
+        ):
+            self.failed(error)
+        elif error is None or isinstance(error, OutputError):
+            self.succeeded()
+
+    def succeeded(self):
+
+        self.consecutive_failures = 0
+        self.results.append(True)
+
+        if self.state == "half_open":
+            self.state = "closed"
+            self.results.clear()
+
+    def failed(self, error):
+
+        self.consecutive_failures += 1
+        self.results.append(False)
+        self.last_error = str(error)
+        self.last_error_at = time.time()
+
+        if (
+            self.state == "half_open"
+            or self.consecutive_failures >= circuit_failures
+            or len(self.results) == self.results.maxlen
+            and self.error_rate() >= circuit_error_rate
+        ):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.results.clear()
+
+    def error_rate(self):
+        return self.results.count(False) / len(self.results) if self.results else 0
+
+    def retry_in(self):
+
+        # While a probe is in flight there's nothing to wait for but its result.
+        if self.state == "open":
+            return max(1, self.opened_at + circuit_open_time - time.monotonic())
+
+        return 1
+
+    def status(self, output, account_name):
+        return {
+            "output": output,
+            "account": account_name,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "error_rate": round(self.error_rate(), 3),
+            "retry_in": round(self.retry_in(), 1) if self.state != "closed" else 0,
+            "last_error": self.last_error,
+            "last_error_at": (
+                email.utils.formatdate(self.last_error_at, usegmt=True)
+                if self.last_error_at is not None
+                else None
+            ),
+        }
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
 
+class CircuitOpenError(OutputError):
+    def __init__(self, circuit_breaker):
+        super().__init__(
+            "Circuit is open, last error: " + str(circuit_breaker.last_error)
+        )
+        self.retry_in = circuit_breaker.retry_in()
 
-@app.post(
-    "/lazylibrarian/{api_key}",
-    summary=desc_lazylibrarian,
-    description=desc_lazylibrarian,
-    tags=["Service Webhooks"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def webhook_lazylibrarian(api_key: str, payload: Request):
 
-    if api_key == app_api_key:
+circuit_breakers = {}
 
-        try:
 
-            result = await payload.json()
-            send_output(result, subject_lazylibrarian, result["text"], "", 0)
-            return {"result": input_success}
+def get_circuit_breaker(output, account):
 
-        except Exception:
+    key = (output, json.dumps(account, sort_keys=True))
 
-            return {"result": input_failure}
+    if key not in circuit_breakers:
+        circuit_breakers[key] = CircuitBreaker()
 
-    else:
+    return circuit_breakers[key]
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
 
+# Stored notifications are read a page at a time, and each page is sent before the
+# next one is read, so a replay of any size only holds one page in memory and its
+# sends are paced by the rate limiters like any others.
+def journal_pages(since, until, endpoint, source, entry_status):
 
-@app.post(
-    "/radarr/{api_key}",
-    summary=desc_radarr,
-    description=desc_radarr,
-    tags=["Service Webhooks"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def webhook_radarr(api_key: str, payload: Request):
+    after = 0
 
-    if api_key == app_api_key:
+    while True:
 
-        try:
+        rows = journal.query(
+            since,
+            until,
+            endpoint,
+            source,
+            entry_status,
+            after=after,
+            limit=max_concurrent_outputs,
+        )
 
-            result = await payload.json()
-            full_message = (
-                str(result["movie"]["title"])
-                + " ["
-                + str(result["movie"]["year"])
-                + "]"
-            )
-            send_output(result, subject_radarr, full_message, "", 0)
-            return {"result": input_success}
+        if not rows:
+            return
 
-        except Exception:
+        page = []
 
-            return {"result": input_failure}
+        for seq, _, _, segment, offset in rows:
 
-    else:
+            after = seq
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+            try:
+                page.append(journal.notification(segment, offset))
+            except FileNotFoundError:
+                continue
 
+        yield page
 
-@app.post(
-    "/sonarr/{api_key}",
-    summary=desc_sonarr,
-    description=desc_sonarr,
-    tags=["Service Webhooks"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def webhook_sonarr(api_key: str, payload: Request):
 
-    if api_key == app_api_key:
+def dead_letter_pages(since, until, endpoint, source, output):
 
-        try:
+    after = 0
+    seen = set()
 
-            result = await payload.json()
-
-            subject_end = ""
-            match result["eventType"]:
-                case "Backup":
-                    subject_end = " -- Episode Backed Up"
-                case "Corrupt":
-                    subject_end = " -- Episode Corrupted"
-                case "Deleted":
-                    subject_end = " -- Episode Deleted"
-                case "Download":
-                    subject_end = " -- Episode Downloaded"
-                case "Event":
-                    subject_end = " -- Event"
-                case "Failed":
-                    subject_end = " -- Corrupted"
-                case "Grab":
-                    subject_end = " -- Grabbed"
-                case "Health":
-                    subject_end = " -- Health Issues"
-                case "Test":
-                    subject_end = " -- Test"
-                case "Update":
-                    subject_end = " -- Updated"
-                case "Upgrade":
-                    subject_end = " -- Upgraded"
-            full_subject = subject_sonarr + subject_end
-
-            # The Sonarr test notification doesn't include an air date, in which case a default value needs to be set
-            try:
+    while True:
 
-                air_date = result["episodes"][0]["airDate"]
+        rows = dead_letters.page(after, since, until, output, max_concurrent_outputs)
 
-            except:
+        if not rows:
+            return
 
-                air_date = "unknown air date"
+        page = []
 
-            full_message = (
-                str(result["eventType"])
-                + "\n\n"
-                + str(result["series"]["title"])
-                + " - "
-                + str(result["episodes"][0]["seasonNumber"])
-                + "x"
-                + str(result["episodes"][0]["episodeNumber"])
-                + " - "
-                + str(result["episodes"][0]["title"])
-                + " ["
-                + str(air_date)
-                + "]"
+        for after, data in rows:
+
+            notification = Notification.from_json(data)
+
+            # A notification that failed on several outputs has a dead letter for each
+            # of them, but goes through the routing again only once.
+            if notification.id in seen:
+                continue
+
+            seen.add(notification.id)
+
+            if endpoint is not None and notification.endpoint != endpoint:
+                continue
+
+            if (
+                source is not None
+                and str(notification.fields().get("source")) != source
+            ):
+                continue
+
+            page.append(notification)
+
+        yield page
+
+
+async def replay_notification(notification):
+
+    if journal is not None:
+        journal.replayed(notification)
+
+    if outbox is not None:
+        outbox.put(notification)
+        return {"id": notification.id, "result": "queued"}
+
+    errors = [
+        str(result)
+        for result in await dispatch_notification(notification)
+        if isinstance(result, Exception)
+    ]
+
+    if errors:
+        return {"id": notification.id, "result": "failed", "errors": errors}
+
+    return {"id": notification.id, "result": "sent"}
+
+
+async def replay(pages):
+
+    replayed = 0
+    failed = 0
+
+    for page in pages:
+
+        for result in await asyncio.gather(*map(replay_notification, page)):
+
+            replayed += 1
+            failed += result["result"] == "failed"
+            yield json_dumps(result) + b"\n"
+
+    yield json_dumps({"replayed": replayed, "failed": failed}) + b"\n"
+
+
+async def send_output(request_body, subject, message, url, priority, endpoint=None):
+
+    notification = Notification(request_body, subject, message, url, priority, endpoint)
+
+    if outbox is not None:
+        outbox.put(notification)
+        return status.HTTP_202_ACCEPTED
+
+    await dispatch_notification(notification)
+    return status.HTTP_200_OK
+
+
+async def dispatch_notification(notification):
+
+    if journal is not None:
+        journal.record(notification)
+
+    if deduplicator is not None and not deduplicator.admit(notification):
+        if journal is not None:
+            journal.mark(notification, "suppressed")
+        return []
+
+    if coalescer is not None and coalescer.hold(notification):
+        notification.cache["held"] = True
+        if journal is not None:
+            journal.mark(notification, "held")
+        return []
+
+    return await deliver_notification(notification)
+
+
+async def deliver_notification(notification):
+
+    # Dedup summaries and digests are journaled here, as they never pass through
+    # dispatch_notification.
+    if journal is not None:
+        journal.record(notification)
+
+    # Every account the notification is routed to is sent to at the same time, so a
+    # request only waits as long as the slowest output. The blocking senders run in
+    # worker threads, which keeps the event loop free for other callers.
+    deliveries = [
+        send_to_account(destination, notification)
+        for destination in route_notification(dispatch_table, notification)
+    ]
+
+    return await asyncio.gather(*deliveries, return_exceptions=True)
+
+
+async def send_to_account(destination, notification):
+
+    await deliver_to_account(
+        destination, notification, output_semaphore, 1, time.monotonic()
+    )
+
+
+async def deliver_to_account(
+    destination, notification, semaphore, attempt, first_attempt
+):
+
+    started = time.perf_counter()
+
+    try:
+
+        await send_guarded(destination, notification, semaphore)
+
+    except CircuitOpenError as error:
+
+        # A send that was skipped because of an open circuit doesn't use up an attempt,
+        # it waits until the circuit is about to be probed and goes again.
+        delay = random.uniform(error.retry_in, error.retry_in * 1.2)
+
+        if time.monotonic() + delay - first_attempt < retry_max_age:
+            result = "skipped"
+            start_background_task(
+                retry_later(delay, destination, notification, attempt, first_attempt)
+            )
+        else:
+            result = "failed"
+            dead_letters.put(
+                destination.output, destination.account, notification, attempt, error
             )
 
-            send_output(result, full_subject, full_message, "", 0)
-            return {"result": input_success}
+        record_attempt(destination, notification, attempt, result, started, error)
+        raise
+
+    except Exception as error:
+
+        if (
+            isinstance(error, OutputError)
+            and error.retryable
+            and attempt < retry_max_attempts
+            and time.monotonic() - first_attempt < retry_max_age
+        ):
+            result = "retrying"
+            schedule_retry(destination, notification, attempt, first_attempt)
+        else:
+            result = "failed"
+            dead_letters.put(
+                destination.output, destination.account, notification, attempt, error
+            )
 
-        except Exception:
+        record_attempt(destination, notification, attempt, result, started, error)
+        raise
 
-            return {"result": input_failure}
+    record_attempt(destination, notification, attempt, "delivered", started, None)
 
-    else:
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+def record_attempt(destination, notification, attempt, result, started, error):
 
+    if journal is not None:
+        journal.record_attempt(
+            destination,
+            notification,
+            attempt,
+            result,
+            round(time.perf_counter() - started, 6),
+            error,
+        )
 
-@app.post(
-    "/synology/{api_key}",
-    summary=desc_synology,
-    description=desc_synology,
-    tags=["Service Webhooks"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def webhook_synology(api_key: str, payload: Request):
 
-    if api_key == app_api_key:
+async def send_guarded(destination, notification, semaphore):
 
-        try:
+    circuit_breaker = get_circuit_breaker(destination.output, destination.account)
 
-            result = await payload.json()
-            send_output(result, subject_synology, result["message"], "", 0)
-            return {"result": input_success}
+    # An open circuit fails straight away, rather than waiting on a provider that is
+    # known to be down.
+    if not circuit_breaker.allow():
+        raise CircuitOpenError(circuit_breaker)
 
-        except Exception:
+    try:
+        await send_paced(destination, notification, semaphore)
+    except BaseException as error:
+        circuit_breaker.record(error)
+        raise
 
-            return {"result": input_failure}
+    circuit_breaker.record(None)
 
-    else:
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+async def send_paced(destination, notification, semaphore):
 
+    rate_limiter = get_rate_limiter(destination.output, destination.account)
 
-@app.post(
-    "/tailscale/{api_key}",
-    summary=desc_tailscale,
-    description=desc_tailscale,
-    tags=["Service Webhooks"],
-    status_code=status.HTTP_200_OK,
-    include_in_schema=True,
-)
-async def webhook_tailscale(api_key: str, payload: Request):
+    # A rate limited send waits for as long as the provider asks and then goes again,
+    # rather than being counted as a failed attempt.
+    for _ in range(5):
 
-    if api_key == app_api_key:
+        await rate_limiter.acquire()
 
         try:
 
-            result = await payload.json()
+            async with client_turn(destination.client), semaphore:
+                response = await send_measured(destination, notification)
 
-            for event in result:
+        except OutputError as error:
 
-                full_message = (
-                    "Type: " + str(event["type"]) + "\n" + str(event["message"])
-                )
+            rate_limiter.observe(error.response)
 
-                if event["data"] not in (None, ""):
-                    full_message = full_message + ("\n\nData: " + str(event["data"]))
+            if error.rate_limited:
+                rate_limited = error
+                continue
 
-                send_output(
-                    event,
-                    subject_tailscale + " (" + event["tailnet"] + ")",
-                    full_message,
-                    "",
-                    0,
-                )
+            raise
 
-            return {"result": input_success}
+        rate_limiter.observe(response)
+        return
 
-        except Exception:
+    raise rate_limited
 
-            return {"result": input_failure}
 
-    else:
+def client_turn(client):
 
-        return {"result": "Invalid API Key (" + str(status.HTTP_401_UNAUTHORIZED) + ")"}
+    # An SMTP session sends one message at a time. Queueing for it here, before a
+    # thread or a place in the semaphore is taken, keeps a slow mail server from
+    # holding up the other outputs.
+    if isinstance(client, SMTPSession):
+        return client.turn
 
+    return contextlib.nullcontext()
 
-def send_output(request_body, subject, message, url, priority):
 
-    for output in current_outputs:
+async def send_measured(destination, notification):
 
-        try:
+    output, account, client = destination
+    labels = (output, account.get("name", output))
+    result = "failure"
+    started = time.perf_counter()
+    metrics.outputs_in_flight += 1
+
+    try:
+        response = await asyncio.get_running_loop().run_in_executor(
+            output_executor, senders[output], client, account, notification
+        )
+        result = "success"
+        return response
+    except OutputError as error:
+        if error.rate_limited:
+            result = "rate_limited"
+        raise
+    finally:
+        metrics.outputs_in_flight -= 1
+        metrics.output_sends[labels + (result,)] += 1
+        metrics.output_latency[labels].observe(time.perf_counter() - started)
+
+
+def schedule_retry(destination, notification, attempt, first_attempt):
+
+    # Exponential backoff with jitter, so accounts that failed together don't all retry
+    # at the same moment.
+    delay = min(retry_max_delay, retry_base_delay * 2 ** (attempt - 1))
+    delay = random.uniform(delay / 2, delay)
+
+    start_background_task(
+        retry_later(delay, destination, notification, attempt + 1, first_attempt)
+    )
 
-            match output:
-                case "discord":
-                    send_discord(subject, message, url)
-                case "email":
-                    send_email(subject, message, url)
-                case "gotify":
-                    send_gotify(subject, message, url, priority)
-                case "matrix":
-                    send_matrix(subject, message, url)
-                case "ntfysh":
-                    send_ntfysh(subject, message, url, priority)
-                case "pushbullet":
-                    send_pushbullet(subject, message, url)
-                case "pushover":
-                    send_pushover(subject, message, url, priority)
-                case "telegram":
-                    send_telegram(subject, message, url)
-                case "webhook":
-                    send_webhook(request_body)
 
-        except:
+async def retry_later(delay, destination, notification, attempt, first_attempt):
+
+    metrics.retries_pending += 1
 
-            return status.HTTP_400_BAD_REQUEST
+    try:
+        await asyncio.sleep(delay)
+    finally:
+        metrics.retries_pending -= 1
+
+    with contextlib.suppress(Exception):
+        await deliver_to_account(
+            destination, notification, retry_semaphore, attempt, first_attempt
+        )
 
 
-def send_discord(subject, message, url):
+def send_discord(client, account, notification):
 
-    full_message = build_message("discord", subject, message, url, "", "")
+    full_message = notification.render(message_style("discord", "markdown"))
 
     headers = {
         "Content-Type": "application/json",
     }
 
-    for account in outputs["discord"]:
+    data = notification.encode(
+        {"username": account["username"], "content": full_message},
+        "discord",
+        account["username"],
+    )
 
-        data = json.dumps({"username": account["username"], "content": full_message})
+    try:
 
-        try:
+        response = client.post(account["url"], headers=headers, data=data)
+        response.raise_for_status()
 
-            response = requests.post(account["url"], headers=headers, data=data)
-            response.raise_for_status()
+        return response
 
-        except requests.exceptions.RequestException as error:
+    except requests.exceptions.RequestException as error:
 
-            raise SystemExit(error)
+        raise OutputError(error)
 
 
-def send_email(subject, message, url):
+class SMTPSession:
+    def __init__(self, account):
+        self.account = account
+        self.server = None
+        self.last_used = 0
+        self.turn = asyncio.Lock()
+        self.lock = threading.RLock()
 
-    for account in outputs["email"]:
+    def send(self, sender, receiver, message):
 
-        full_message = build_message(
-            "email",
-            subject,
-            message,
-            url,
-            account["email_sender"],
-            account["email_receiver"],
-        )
+        # Sends are already queued one at a time by client_turn(), so a burst of
+        # notifications goes out over a single authenticated session. The lock keeps
+        # the session from being closed in the middle of one.
+        with self.lock:
+            self.deliver(sender, receiver, message)
 
-        if account["protocol"] == "tls":
+    def deliver(self, sender, receiver, message):
 
-            context = ssl.create_default_context()
-            server = smtplib.SMTP(account["server"], int(account["port"]))
-            server.starttls(context=context)
-            server.login(account["username"], account["password"])
-            server.sendmail(
-                account["email_sender"], account["email_receiver"], full_message
-            )
+        if not self.is_healthy():
+            self.connect()
+
+        try:
+            self.server.sendmail(sender, receiver, message)
+        except smtplib.SMTPServerDisconnected:
+            self.connect()
+            self.server.sendmail(sender, receiver, message)
 
+        self.last_used = time.monotonic()
 
-def send_gotify(subject, message, url, priority):
+    def connect(self):
 
-    full_message = build_message("gotify", subject, message, url, "", "")
+        self.close()
 
-    data = {"title": subject, "message": full_message, "priority": priority}
+        server = self.account["server"]
+        port = int(self.account["port"])
 
-    for account in outputs["gotify"]:
+        match self.account["protocol"]:
+            case "ssl":
+                connection = smtplib.SMTP_SSL(
+                    server,
+                    port,
+                    timeout=output_timeout,
+                    context=ssl.create_default_context(),
+                )
+            case "tls" | "plain":
+                connection = smtplib.SMTP(server, port, timeout=output_timeout)
+            case _:
+                raise OutputError("Unknown email protocol: " + self.account["protocol"])
+
+        # The session is only kept once STARTTLS and the login have both gone through,
+        # otherwise a retry could reuse it unencrypted or logged out.
+        try:
+            if self.account["protocol"] == "tls":
+                connection.starttls(context=ssl.create_default_context())
+
+            if self.account.get("username"):
+                connection.login(self.account["username"], self.account["password"])
+        except BaseException:
+            connection.close()
+            raise
+
+        self.server = connection
+        self.last_used = time.monotonic()
+
+    def is_healthy(self):
+
+        if self.server is None:
+            return False
+
+        idle = time.monotonic() - self.last_used
 
-        full_url = account["url"] + "/message?token=" + account["token"]
+        if idle > smtp_idle_timeout:
+            self.close()
+            return False
+
+        # Back-to-back sends skip the NOOP round trip, a dropped connection is still
+        # caught by the reconnect in deliver().
+        if idle < 5:
+            return True
 
         try:
+            return self.server.noop()[0] == 250
+        except OSError:
+            return False
+
+    def close(self):
+
+        with self.lock:
+            if self.server is not None:
+                try:
+                    self.server.quit()
+                except OSError:
+                    self.server.close()
+                self.server = None
+
+
+def smtp_key(account):
+
+    # Accounts that share a server and login also share one session.
+    return (
+        "email",
+        account["protocol"],
+        account["server"],
+        str(account["port"]),
+        account.get("username"),
+        account.get("password"),
+    )
+
+
+def send_email(client, account, notification):
+
+    full_message = notification.render(
+        "rfc5322", account["email_sender"], account["email_receiver"]
+    )
+
+    try:
+
+        client.send(account["email_sender"], account["email_receiver"], full_message)
 
-            response = requests.post(full_url, data=data)
-            response.raise_for_status()
+    except OSError as error:
 
-        except requests.exceptions.RequestException as error:
+        raise OutputError(error)
 
-            raise SystemExit(error)
 
+def send_gotify(client, account, notification):
 
-def send_matrix(subject, message, url):
+    full_message = notification.render(message_style("gotify", "plain"))
+
+    data = {
+        "title": notification.subject,
+        "message": full_message,
+        "priority": notification.priority,
+    }
+
+    full_url = account["url"] + "/message?token=" + account["token"]
+
+    try:
+
+        response = client.post(full_url, data=data)
+        response.raise_for_status()
+
+        return response
+
+    except requests.exceptions.RequestException as error:
+
+        raise OutputError(error)
 
-    full_message = build_message("matrix", subject, message, url, "", "")
+
+def send_matrix(client, account, notification):
+
+    full_message = notification.render(message_style("matrix", "markdown"))
 
     headers = {
         "Content-Type": "application/json",
     }
 
-    for account in outputs["matrix"]:
+    content = {"msgtype": "m.text", "body": full_message}
 
-        data = json.dumps({"msgtype": "m.text", "body": full_message})
+    # Clients that understand HTML show the formatted version, the rest fall back to
+    # the Markdown in the body.
+    if "matrix" not in dispatch_table.templates:
+        content["format"] = "org.matrix.custom.html"
+        content["formatted_body"] = notification.render("html").replace("\n", "<br>")
 
-        try:
+    data = notification.encode(content, "matrix")
 
-            random_string = str(uuid.uuid4())
+    try:
 
-            full_url = (
-                account["url"]
-                + "/_matrix/client/r0/rooms/"
-                + account["room"]
-                + "/send/m.room.message/"
-                + random_string
-                + "?access_token="
-                + account["token"]
-            )
+        random_string = str(uuid.uuid4())
 
-            response = requests.put(full_url, data=data, headers=headers)
+        full_url = (
+            account["url"]
+            + "/_matrix/client/r0/rooms/"
+            + account["room"]
+            + "/send/m.room.message/"
+            + random_string
+            + "?access_token="
+            + account["token"]
+        )
+
+        response = client.put(full_url, data=data, headers=headers)
 
-            response.raise_for_status()
+        response.raise_for_status()
 
-        except requests.exceptions.RequestException as error:
+        return response
 
-            raise SystemExit(error)
+    except requests.exceptions.RequestException as error:
 
+        raise OutputError(error)
 
-def send_ntfysh(subject, message, url, priority):
+
+def send_ntfysh(client, account, notification):
 
     headers = {}
 
-    if subject and subject != "":
-        headers["Title"] = subject
+    if notification.subject and notification.subject != "":
+        headers["Title"] = notification.subject
 
-    if url and url != "":
-        headers["Click"] = url
+    if notification.url and notification.url != "":
+        headers["Click"] = notification.url
 
-    if priority and priority != "":
-        headers["Priority"] = priority
+    if notification.priority and notification.priority != "":
+        headers["Priority"] = notification.priority
 
-    for account in outputs["ntfysh"]:
+    try:
 
-        try:
+        response = client.post(
+            account.get("url", "https://ntfy.sh").rstrip("/") + "/" + account["topic"],
+            headers=headers,
+            data=notification.message,
+        )
+        response.raise_for_status()
 
-            response = requests.post(
-                "https://ntfy.sh/" + account["topic"], headers=headers, data=message
-            )
-            response.raise_for_status()
+        return response
 
-        except requests.exceptions.RequestException as error:
+    except requests.exceptions.RequestException as error:
 
-            raise SystemExit(error)
+        raise OutputError(error)
 
 
-def send_pushbullet(subject, message, url):
+def send_pushbullet(client, account, notification):
 
-    data = json.dumps(
+    data = notification.encode(
         {
-            "body": message,
-            "title": subject,
+            "body": notification.message,
+            "title": notification.subject,
             "type": "note",
-            "url": url,
-        }
+            "url": notification.url,
+        },
+        "pushbullet",
     )
 
-    for account in outputs["pushbullet"]:
+    headers = {
+        "Access-Token": account["api_key"],
+        "Content-Type": "application/json",
+    }
 
-        try:
+    try:
 
-            headers = {
-                "Access-Token": account["api_key"],
-                "Content-Type": "application/json",
-            }
+        response = client.post(
+            account.get("url", "https://api.pushbullet.com").rstrip("/") + "/v2/pushes",
+            headers=headers,
+            data=data,
+        )
+        response.raise_for_status()
 
-            response = requests.post(
-                "https://api.pushbullet.com/v2/pushes", headers=headers, data=data
-            )
-            response.raise_for_status()
+        return response
 
-        except requests.exceptions.RequestException as error:
+    except requests.exceptions.RequestException as error:
 
-            raise SystemExit(error)
+        raise OutputError(error)
 
 
-def send_pushover(subject, message, url, priority):
+def send_pushover(client, account, notification):
 
-    api_url = "https://api.pushover.net/1/messages.json"
+    api_url = (
+        account.get("url", "https://api.pushover.net").rstrip("/") + "/1/messages.json"
+    )
 
-    for account in outputs["pushover"]:
+    body = {
+        "message": notification.message,
+        "priority": notification.priority,
+        "title": notification.subject,
+        "token": account["api_token"],
+        "url": notification.url,
+        "user": account["api_user"],
+    }
 
-        body = {
-            "message": message,
-            "priority": priority,
-            "title": subject,
-            "token": account["api_token"],
-            "url": url,
-            "user": account["api_user"],
-        }
+    try:
 
-        try:
+        response = client.post(url=api_url, data=body)
+        response.raise_for_status()
 
-            response = requests.post(url=api_url, data=body)
-            response.raise_for_status()
+        return response
 
-        except requests.exceptions.RequestException as error:
+    except requests.exceptions.RequestException as error:
 
-            raise SystemExit(error)
+        raise OutputError(error)
 
 
-def send_telegram(subject, message, url):
+def send_telegram(client, account, notification):
 
-    full_message = build_message("telegram", subject, message, url, "", "")
+    full_message = notification.render(message_style("telegram", "html"))
 
-    for account in outputs["telegram"]:
+    api_url = (
+        account.get("url", "https://api.telegram.org").rstrip("/")
+        + "/bot"
+        + account["api_key"]
+        + "/sendMessage"
+    )
 
-        api_url = "https://api.telegram.org/bot" + account["api_key"] + "/sendMessage"
+    body = {
+        "chat_id": account["user_id"],
+        "disable_web_page_preview": "true",
+        "parse_mode": "HTML",
+        "text": full_message,
+    }
 
-        body = {
-            "chat_id": account["user_id"],
-            "disable_web_page_preview": "true",
-            "parse_mode": "HTML",
-            "text": full_message,
-        }
+    try:
 
-        try:
+        response = client.post(url=api_url, data=body)
+        response.raise_for_status()
 
-            response = requests.post(url=api_url, data=body)
-            response.raise_for_status()
+        return response
 
-        except requests.exceptions.RequestException as error:
+    except requests.exceptions.RequestException as error:
 
-            raise SystemExit(error)
+        raise OutputError(error)
 
 
-def send_webhook(json):
+def send_webhook(client, account, notification):
 
     headers = {
         "Content-Type": "application/json",
     }
 
-    for account in outputs["webhook"]:
+    try:
+
+        response = client.post(
+            url=account["url"],
+            headers=headers,
+            data=notification.encode(notification.request_body, "webhook"),
+        )
+        response.raise_for_status()
+
+        return response
+
+    except requests.exceptions.RequestException as error:
+
+        raise OutputError(error)
 
-        try:
 
-            response = requests.post(url=account["url"], headers=headers, json=json)
-            response.raise_for_status()
+def message_style(output, default):
+    return output if output in dispatch_table.templates else default
 
-        except requests.exceptions.RequestException as error:
 
-            raise SystemExit(error)
+def build_message(style, notification, *args):
 
+    subject = notification.subject or ""
+    message = notification.message or ""
+    url = notification.url or ""
 
-def build_message(type, subject, message, url, email_sender, email_receiver):
+    match style:
 
-    full_message = ""
+        case "plain":
 
-    # SUBJECT
-    if subject and subject != "":
+            full_message = message
 
-        if type == "telegram":
+            if url != "":
+                full_message += "\n\n" + url
 
-            full_message += "<strong>" + subject + "</strong>"
+        case "markdown":
 
-        elif type == "discord" or type == "matrix":
+            full_message = "**" + subject + "**" if subject != "" else ""
 
-            full_message += subject
+            if message != "":
+                full_message += "\n" + message
 
-    # COMMON
-    if type == "discord" or type == "gotify" or type == "matrix" or type == "telegram":
+            if url != "":
+                full_message += "\n\n" + url
 
-        if message and message != "":
-            full_message += "\n" + message
+        case "html":
 
-        if url and url != "":
-            full_message += "\n\n" + url
+            full_message = (
+                "<strong>" + html.escape(subject, quote=False) + "</strong>"
+                if subject != ""
+                else ""
+            )
+
+            if message != "":
+                full_message += "\n" + html.escape(message, quote=False)
+
+            if url != "":
+                full_message += "\n\n" + html.escape(url, quote=False)
+
+        # The whole email, kept apart from the styles named after outputs so that an
+        # "email" message template only replaces the body.
+        case "rfc5322":
+
+            email_sender, email_receiver = args
+
+            email_message = email.message.EmailMessage()
+            email_message["From"] = email_sender
+            email_message["To"] = email_receiver
+            email_message["Subject"] = subject
+            email_message["Date"] = email.utils.formatdate(localtime=True)
+            email_message["Message-ID"] = email.utils.make_msgid()
+            email_message.set_content(
+                notification.render(message_style("email", "plain"))
+            )
 
-    # EMAIL
-    if type == "email":
+            full_message = email_message.as_bytes()
 
-        full_message = "From: " + email_sender + "\n"
-        full_message += "To: " + email_receiver + "\n"
-        full_message += "Subject: " + subject + "\n\n"
-        full_message += message
+        case _:
 
-        if url and url != "":
-            full_message += "\n\n" + url
+            full_message = dispatch_table.templates[style].render(
+                subject=subject,
+                message=message,
+                url=url,
+                priority=notification.priority,
+                endpoint=notification.endpoint,
+                body=notification.fields(),
+            )
 
     return full_message
+
+
+senders = {
+    "discord": send_discord,
+    "email": send_email,
+    "gotify": send_gotify,
+    "matrix": send_matrix,
+    "ntfysh": send_ntfysh,
+    "pushbullet": send_pushbullet,
+    "pushover": send_pushover,
+    "telegram": send_telegram,
+    "webhook": send_webhook,
+}
+
+# Templates from config.yaml are compiled once, when the configuration is loaded.
+template_environment = jinja2.Environment(keep_trailing_newline=True)
+
+# Deliveries read the table once and keep using it, so swapping in a new one on reload
+# lets anything in flight finish with the configuration it started with.
+dispatch_table = build_dispatch_table(configuration)
+
+logger = logging.getLogger("uvicorn.error")
+config_watcher = None
+
+
+async def reload_configuration():
+
+    global dispatch_table
+
+    # Reading and checking the new configuration happens before anything is swapped, so
+    # a broken config.yaml leaves the running configuration untouched.
+    try:
+        new_configuration = await asyncio.to_thread(read_configuration, config_path)
+        new_table = build_dispatch_table(new_configuration, dispatch_table)
+    except Exception as error:
+        logger.error("Configuration was not reloaded: %s", error)
+        return
+
+    previous_table = dispatch_table
+    dispatch_table = new_table
+
+    for key, client in previous_table.clients.items():
+        if new_table.clients.get(key) is not client:
+            start_background_task(close_client(client))
+
+    logger.info("Configuration reloaded from %s", config_path)
+
+
+async def close_client(client):
+
+    # Deliveries that started before the reload keep using the old clients, so a
+    # replaced SMTP session is only closed once the sends queued for it are done, and
+    # off the event loop, as QUIT can take up to output_timeout.
+    async with client_turn(client):
+        await asyncio.get_running_loop().run_in_executor(output_executor, client.close)
+
+
+async def watch_configuration():
+
+    modified = os.stat(config_path).st_mtime
+
+    while True:
+
+        await asyncio.sleep(config_watch_interval)
+
+        try:
+            current = os.stat(config_path).st_mtime
+        except OSError:
+            continue
+
+        if current != modified:
+            modified = current
+
+            # The watcher has to outlive any single broken edit of config.yaml, or
+            # later fixes to it would never be picked up.
+            try:
+                await reload_configuration()
+            except Exception:
+                logger.exception("Configuration was not reloaded")
+
+
+@app.on_event("startup")
+def start_config_watcher():
+
+    global config_watcher
+
+    loop = asyncio.get_running_loop()
+
+    # Signal handlers can only be installed from the main thread on Unix.
+    with contextlib.suppress(NotImplementedError, RuntimeError, ValueError):
+        loop.add_signal_handler(
+            signal.SIGHUP, lambda: start_background_task(reload_configuration())
+        )
+
+    if config_watch_interval > 0:
+        config_watcher = loop.create_task(watch_configuration())
+
+
+@app.on_event("shutdown")
+async def flush_digests():
+
+    if coalescer is None:
+        return
+
+    # Digests that are still waiting are sent before the outputs are closed, instead
+    # of being dropped along with their timers.
+    deliveries = [coalescer.flush(key) for key in list(coalescer.digests)]
+
+    if deliveries:
+        await asyncio.wait(deliveries, timeout=output_timeout)
+
+
+@app.on_event("shutdown")
+def close_outputs():
+
+    if outbox_worker is not None:
+        outbox_worker.cancel()
+
+    if config_watcher is not None:
+        config_watcher.cancel()
+
+    if outbox is not None:
+        outbox.close()
+
+    for task in background_tasks:
+        task.cancel()
+
+    dead_letters.close()
+
+    if journal is not None:
+        journal.close()
+
+    for client in dispatch_table.clients.values():
+        client.close()
+
+    output_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,460 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import yaml
+
+from stubs import start_stubs, stop_stubs, stub_accounts
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+repository_dir = os.path.dirname(benchmark_dir)
+
+payloads_path = os.path.join(benchmark_dir, "payloads.json")
+default_baseline_path = os.path.join(benchmark_dir, "baseline.json")
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark every HomelabAPI input route against local stub providers."
+    )
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=1000,
+        help="sends per second allowed per output account",
+    )
+    parser.add_argument("--outputs", default="all", help="current_outputs to send to")
+    parser.add_argument("--routes", help="comma separated routes to run")
+    parser.add_argument("--outbox", action="store_true", help="enable the outbox")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="uvicorn worker processes"
+    )
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--baseline", default=default_baseline_path)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown against the baseline before it counts as a regression",
+    )
+    parser.add_argument("--output-json", help="also write the results to this file")
+
+    return parser.parse_args()
+
+
+def free_port():
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def write_configuration(directory, arguments, servers, api_key):
+
+    configuration = {
+        "application": {
+            "api_name": "HomelabAPI Benchmark",
+            "api_key": api_key,
+            "config_watch_interval": 0,
+            "current_outputs": arguments.outputs,
+            "database": os.path.join(directory, "homelabapi.db"),
+            "max_concurrent_outputs": max(10, arguments.concurrency),
+            "metrics": True,
+            "outbox": arguments.outbox,
+            "retry_base_delay": 0.5,
+            "retry_max_delay": 2,
+        },
+        "outputs": stub_accounts(servers, arguments.rate_limit),
+    }
+
+    path = os.path.join(directory, "config.yaml")
+
+    with open(path, mode="wt", encoding="utf-8") as file:
+        yaml.safe_dump(configuration, file)
+
+    return path
+
+
+def start_server(config_path, port, workers):
+
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app.main:app",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+            "--workers",
+            str(workers),
+        ],
+        cwd=repository_dir,
+        env={**os.environ, "HOMELABAPI_CONFIG": config_path},
+    )
+
+    base_url = "http://127.0.0.1:" + str(port)
+    deadline = time.monotonic() + 30
+
+    while time.monotonic() < deadline:
+
+        if server.poll() is not None:
+            raise RuntimeError("HomelabAPI exited during startup")
+
+        try:
+            requests.head(base_url + "/", timeout=1)
+            return server, base_url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError("HomelabAPI didn't start within 30 seconds")
+
+
+def fill_api_key(value, api_key):
+
+    if isinstance(value, dict):
+        return {key: fill_api_key(item, api_key) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [fill_api_key(item, api_key) for item in value]
+    elif value == "{api_key}":
+        return api_key
+    else:
+        return value
+
+
+def notifications_per_request(payload):
+    return len(payload) if isinstance(payload, list) else 1
+
+
+def percentile(values, fraction):
+
+    if not values:
+        return 0
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_route(base_url, route, payload, api_key, arguments):
+
+    url = base_url + route.replace("{api_key}", api_key)
+    body = json.dumps(fill_api_key(payload, api_key))
+    headers = {"Content-Type": "application/json"}
+
+    if route == "/input/batch":
+        headers["X-API-Key"] = api_key
+
+    local = threading.local()
+
+    def send(_):
+
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+
+        started = time.perf_counter()
+        response = local.session.post(url, data=body, headers=headers, timeout=120)
+        elapsed = time.perf_counter() - started
+
+        accepted = response.status_code in (200, 202) and "Success" in response.text
+
+        return elapsed, accepted
+
+    started = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(arguments.concurrency) as executor:
+        results = list(executor.map(send, range(arguments.requests)))
+
+    duration = time.perf_counter() - started
+    latencies = [elapsed for elapsed, _ in results]
+
+    return {
+        "requests": len(results),
+        "failed": sum(1 for _, accepted in results if not accepted),
+        "throughput": round(len(results) / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def received_total(servers):
+    return sum(server.behaviour.received for server in servers.values())
+
+
+def wait_for_deliveries(servers, expected, timeout):
+
+    started = time.perf_counter()
+    deadline = time.monotonic() + timeout
+
+    while received_total(servers) < expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    return round(time.perf_counter() - started, 3)
+
+
+histogram_line = re.compile(
+    r'^homelabapi_output_duration_seconds_bucket\{output="([^"]*)",account="[^"]*",'
+    r'le="([^"]*)"\} (\d+)$'
+)
+
+
+def output_latencies(base_url):
+
+    buckets = {}
+
+    for line in requests.get(base_url + "/metrics", timeout=10).text.splitlines():
+
+        match = histogram_line.match(line)
+
+        if match:
+            output, bound, count = match.groups()
+            bound = float("inf") if bound == "+Inf" else float(bound)
+            counts = buckets.setdefault(output, {})
+            counts[bound] = counts.get(bound, 0) + int(count)
+
+    return {
+        output: {
+            "sends": max(counts.values()),
+            "p50_ms": histogram_quantile(counts, 0.5),
+            "p99_ms": histogram_quantile(counts, 0.99),
+        }
+        for output, counts in sorted(buckets.items())
+    }
+
+
+def histogram_quantile(counts, fraction):
+
+    # The same linear interpolation within a bucket that Prometheus uses.
+    bounds = sorted(counts)
+    total = counts[bounds[-1]]
+
+    if total == 0:
+        return 0
+
+    rank = fraction * total
+    lower_bound = 0
+    lower_count = 0
+
+    for bound in bounds:
+
+        if counts[bound] >= rank:
+
+            if bound == float("inf"):
+                return round(lower_bound * 1000, 2)
+
+            share = (rank - lower_count) / max(1, counts[bound] - lower_count)
+            return round((lower_bound + (bound - lower_bound) * share) * 1000, 2)
+
+        lower_bound, lower_count = bound, counts[bound]
+
+    return round(lower_bound * 1000, 2)
+
+
+def compare(results, baseline, tolerance):
+
+    regressions = []
+
+    for route, result in results["routes"].items():
+
+        previous = baseline.get("routes", {}).get(route)
+
+        if previous is None:
+            continue
+
+        if result["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(
+                route
+                + ": throughput "
+                + str(result["throughput"])
+                + "/s, baseline "
+                + str(previous["throughput"])
+                + "/s"
+            )
+
+        if result["p99_ms"] > previous["p99_ms"] * (1 + tolerance):
+            regressions.append(
+                route
+                + ": p99 "
+                + str(result["p99_ms"])
+                + " ms, baseline "
+                + str(previous["p99_ms"])
+                + " ms"
+            )
+
+    return regressions
+
+
+def print_report(results):
+
+    print()
+    print(
+        "{:<30} {:>8} {:>7} {:>10} {:>10} {:>10} {:>9}".format(
+            "route", "requests", "failed", "req/s", "p50 ms", "p99 ms", "drain s"
+        )
+    )
+
+    for route, result in results["routes"].items():
+        print(
+            "{:<30} {:>8} {:>7} {:>10} {:>10} {:>10} {:>9}".format(
+                route,
+                result["requests"],
+                result["failed"],
+                result["throughput"],
+                result["p50_ms"],
+                result["p99_ms"],
+                result["drain_s"],
+            )
+        )
+
+    print()
+    print("{:<30} {:>8} {:>10} {:>10}".format("output", "sends", "p50 ms", "p99 ms"))
+
+    for output, result in results["outputs"].items():
+        print(
+            "{:<30} {:>8} {:>10} {:>10}".format(
+                output, result["sends"], result["p50_ms"], result["p99_ms"]
+            )
+        )
+
+    print()
+
+
+def main():
+
+    arguments = parse_arguments()
+
+    with open(payloads_path, encoding="utf-8") as file:
+        payloads = json.load(file)
+
+    if arguments.routes:
+        selected = [route.strip() for route in arguments.routes.split(",")]
+        payloads = {route: payloads[route] for route in selected}
+
+    servers = start_stubs(
+        arguments.latency, arguments.error_rate, arguments.rate_limit_rate
+    )
+    api_key = secrets.token_hex(20)
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        config_path = write_configuration(directory, arguments, servers, api_key)
+        server, base_url = start_server(config_path, free_port(), arguments.workers)
+
+        try:
+
+            destinations = len(
+                [
+                    account
+                    for output, accounts in stub_accounts(servers, 0).items()
+                    if arguments.outputs == "all"
+                    or output in [name.strip() for name in arguments.outputs.split(",")]
+                    for account in accounts
+                ]
+            )
+
+            results = {
+                "settings": {
+                    name: getattr(arguments, name)
+                    for name in (
+                        "requests",
+                        "concurrency",
+                        "latency",
+                        "error_rate",
+                        "rate_limit_rate",
+                        "outputs",
+                        "outbox",
+                        "workers",
+                    )
+                },
+                "routes": {},
+            }
+
+            for route, payload in payloads.items():
+
+                expected = received_total(servers) + (
+                    arguments.requests
+                    * notifications_per_request(payload)
+                    * destinations
+                )
+
+                result = run_route(base_url, route, payload, api_key, arguments)
+                result["drain_s"] = wait_for_deliveries(
+                    servers, expected, arguments.drain_timeout
+                )
+                results["routes"][route] = result
+
+                print(route, "done", file=sys.stderr)
+
+            results["outputs"] = output_latencies(base_url)
+            results["stubs"] = {
+                output: {
+                    "received": server.behaviour.received,
+                    "errors": server.behaviour.errors,
+                    "rate_limited": server.behaviour.rate_limited,
+                }
+                for output, server in servers.items()
+            }
+
+        finally:
+
+            server.terminate()
+            server.wait()
+            stop_stubs(servers)
+
+    print_report(results)
+
+    if arguments.output_json:
+        with open(arguments.output_json, mode="wt", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    if arguments.save_baseline:
+
+        with open(arguments.baseline, mode="wt", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+        print("Baseline saved to " + arguments.baseline)
+
+    elif os.path.exists(arguments.baseline):
+
+        with open(arguments.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+        if baseline.get("settings") != results["settings"]:
+            print("Baseline was recorded with different settings, not comparing.")
+            return 0
+
+        regressions = compare(results, baseline, arguments.tolerance)
+
+        for regression in regressions:
+            print("Regression: " + regression)
+
+        if regressions:
+            return 1
+
+        print("No regressions against the baseline.")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import yaml
+
+from benchmark import free_port, repository_dir, start_server
+from stubs import start_stubs, stop_stubs, stub_accounts
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser(
+        description="Report where HomelabAPI spends its time while starting up."
+    )
+    parser.add_argument("--outputs", default="all", help="current_outputs to load")
+    parser.add_argument("--top", type=int, default=20, help="imports to list")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts to time")
+
+    return parser.parse_args()
+
+
+def write_configuration(directory, outputs, servers):
+
+    configuration = {
+        "application": {
+            "api_name": "HomelabAPI Startup",
+            "api_key": "startup",
+            "config_watch_interval": 0,
+            "current_outputs": outputs,
+            "database": os.path.join(directory, "homelabapi.db"),
+        },
+        "outputs": stub_accounts(servers, 1000),
+    }
+
+    path = os.path.join(directory, "config.yaml")
+
+    with open(path, mode="wt", encoding="utf-8") as file:
+        yaml.safe_dump(configuration, file)
+
+    return path
+
+
+importtime_line = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def import_times(config_path):
+
+    # -X importtime reports every module as it's imported, with its own time and the
+    # time including everything it imported in turn, both in microseconds.
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        cwd=repository_dir,
+        env={**os.environ, "HOMELABAPI_CONFIG": config_path},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    modules = []
+
+    for line in result.stderr.splitlines():
+
+        match = importtime_line.match(line)
+
+        if not match:
+            continue
+
+        own, cumulative, indent, module = match.groups()
+
+        # Everything up to site is the interpreter starting, not HomelabAPI.
+        if module == "site":
+            modules = []
+        else:
+            modules.append((module, int(own), int(cumulative), len(indent) // 2))
+
+    return modules
+
+
+def cold_start(config_path):
+
+    started = time.perf_counter()
+    server, base_url = start_server(config_path, free_port(), 1)
+    timings = {"first_response_s": time.perf_counter() - started}
+
+    try:
+
+        for name, path in (("openapi_ms", "/openapi.json"), ("index_ms", "/")):
+            started = time.perf_counter()
+            requests.get(base_url + path, timeout=30).raise_for_status()
+            timings[name] = (time.perf_counter() - started) * 1000
+
+    finally:
+
+        server.terminate()
+        server.wait()
+
+    return timings
+
+
+def main():
+
+    arguments = parse_arguments()
+    servers = start_stubs()
+
+    try:
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            config_path = write_configuration(directory, arguments.outputs, servers)
+            modules = import_times(config_path)
+            starts = [cold_start(config_path) for _ in range(arguments.runs)]
+
+    finally:
+
+        stop_stubs(servers)
+
+    # The top level imports of app.main add up to the whole import.
+    total = sum(cumulative for _, _, cumulative, depth in modules if depth == 0)
+
+    print()
+    print("Importing app.main took {:.1f} ms".format(total / 1000))
+    print()
+    print("{:<40} {:>12} {:>12}".format("module", "self ms", "total ms"))
+
+    for module, own, cumulative, depth in sorted(
+        modules, key=lambda module: module[2], reverse=True
+    )[: arguments.top]:
+        print(
+            "{:<40} {:>12.1f} {:>12.1f}".format(
+                "  " * depth + module, own / 1000, cumulative / 1000
+            )
+        )
+
+    print()
+    print("{:<40} {:>12}".format("cold start", "best"))
+
+    for name in ("first_response_s", "openapi_ms", "index_ms"):
+        print("{:<40} {:>12.3f}".format(name, min(start[name] for start in starts)))
+
+    print()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
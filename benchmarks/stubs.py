@@ -0,0 +1,227 @@
+import http.server
+import random
+import socketserver
+import threading
+import time
+
+# Local stand-ins for every output provider. Each provider gets its own server, so the
+# number of deliveries it received can be counted separately, and every server can be
+# made slow, flaky or rate limited.
+
+http_outputs = (
+    "discord",
+    "gotify",
+    "matrix",
+    "ntfysh",
+    "pushbullet",
+    "pushover",
+    "telegram",
+    "webhook",
+)
+
+
+class StubBehaviour:
+    def __init__(self, latency=0, error_rate=0, rate_limit_rate=0, retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.received = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def respond(self):
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        roll = random.random()
+
+        with self.lock:
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                return 429
+            elif roll < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                return 500
+            else:
+                self.received += 1
+                return 200
+
+
+class StubHTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        code = self.server.behaviour.respond()
+        body = b'{"ok": true}' if code == 200 else b'{"ok": false}'
+
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+
+        if code == 429:
+            self.send_header("Retry-After", str(self.server.behaviour.retry_after))
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = handle_request
+    do_PUT = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, behaviour):
+        super().__init__(("127.0.0.1", 0), StubHTTPHandler)
+        self.behaviour = behaviour
+
+
+# Just enough SMTP for smtplib: every command is accepted and messages are counted.
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+
+        self.reply("220 stub ESMTP")
+
+        for line in self.rfile:
+
+            command = line.decode(errors="replace").strip().upper()
+
+            if command.startswith("EHLO"):
+                self.reply("250-stub\r\n250 8BITMIME")
+            elif command.startswith("DATA"):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+
+                code = self.server.behaviour.respond()
+
+                if code == 200:
+                    self.reply("250 OK")
+                elif code == 429:
+                    self.reply("421 Too many messages, try again later")
+                else:
+                    self.reply("451 Local error")
+
+            elif command.startswith("QUIT"):
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, behaviour):
+        super().__init__(("127.0.0.1", 0), StubSMTPHandler)
+        self.behaviour = behaviour
+
+
+def start_stubs(latency=0, error_rate=0, rate_limit_rate=0):
+
+    servers = {}
+
+    for output in http_outputs:
+        servers[output] = StubHTTPServer(
+            StubBehaviour(latency, error_rate, rate_limit_rate)
+        )
+
+    servers["email"] = StubSMTPServer(
+        StubBehaviour(latency, error_rate, rate_limit_rate)
+    )
+
+    for server in servers.values():
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return servers
+
+
+def stop_stubs(servers):
+
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+def stub_accounts(servers, rate_limit):
+
+    def url(output):
+        return "http://127.0.0.1:" + str(servers[output].server_address[1])
+
+    # Provider pacing is lifted by default, otherwise the slowest provider's published
+    # limit (Matrix allows one send every five seconds) is all that gets measured.
+    pacing = {"rate_limit": rate_limit, "rate_limit_burst": rate_limit}
+
+    return {
+        "discord": [
+            {"name": "Discord", "url": url("discord"), "username": "bench", **pacing}
+        ],
+        "email": [
+            {
+                "name": "Email",
+                "server": "127.0.0.1",
+                "port": servers["email"].server_address[1],
+                "protocol": "plain",
+                "email_sender": "bench@example.com",
+                "email_receiver": "bench@example.com",
+                **pacing,
+            }
+        ],
+        "gotify": [
+            {"name": "Gotify", "url": url("gotify"), "token": "bench", **pacing}
+        ],
+        "matrix": [
+            {
+                "name": "Matrix",
+                "url": url("matrix"),
+                "room": "!bench:example.com",
+                "token": "bench",
+                **pacing,
+            }
+        ],
+        "ntfysh": [
+            {"name": "ntfy.sh", "url": url("ntfysh"), "topic": "bench", **pacing}
+        ],
+        "pushbullet": [
+            {
+                "name": "Pushbullet",
+                "url": url("pushbullet"),
+                "api_key": "bench",
+                **pacing,
+            }
+        ],
+        "pushover": [
+            {
+                "name": "Pushover",
+                "url": url("pushover"),
+                "api_token": "bench",
+                "api_user": "bench",
+                **pacing,
+            }
+        ],
+        "telegram": [
+            {
+                "name": "Telegram",
+                "url": url("telegram"),
+                "api_key": "0:bench",
+                "user_id": "1",
+                **pacing,
+            }
+        ],
+        "webhook": [{"name": "Webhook", "url": url("webhook"), **pacing}],
+    }
@@ -0,0 +1,52 @@
+#!/bin/bash
+
+# Sends stored notifications again through the current routing and outputs, for
+# example after switching from one output to another in config.yaml.
+#
+# replay-homelabapi.sh [--dead-letters] [--since TIME] [--until TIME]
+#                      [--endpoint ENDPOINT] [--source SOURCE] [--status STATUS]
+#                      [--output OUTPUT]
+#
+# TIME is anything "date -d" understands, such as "2 hours ago" or "2024-05-01 09:00".
+
+api_url="https://homelabapi.example.com/replay"
+api_key="abc123def456ghi789j0abc123def456ghi789j0"
+
+store="journal"
+query=()
+
+while [ $# -gt 0 ]; do
+  case "$1" in
+    --dead-letters)
+      store="dead_letters"
+      shift
+      ;;
+    --since|--until)
+      query+=("${1#--}=$(date -d "$2" +%s)") || exit 1
+      shift 2
+      ;;
+    --endpoint|--source|--status|--output)
+      query+=("${1#--}=$2")
+      shift 2
+      ;;
+    *)
+      echo "Unknown option: $1" >&2
+      exit 1
+      ;;
+  esac
+done
+
+arguments=(--data-urlencode "store=$store")
+
+for parameter in "${query[@]}"; do
+  arguments+=(--data-urlencode "$parameter")
+done
+
+# Every notification gets a JSON line as it's sent, so the output is shown as it
+# arrives rather than when the replay has finished.
+curl -s -N \
+     -X POST \
+     -G \
+     -H "X-API-Key: $api_key" \
+     "${arguments[@]}" \
+     "$api_url"